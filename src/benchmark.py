@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+Speed comparisons between the decoders on the bundled datasets, and a per-stage benchmark suite
+that compares each run against a saved JSON baseline.
+
+Usage (from src/):
+    python benchmark.py viterbi2 all --limit 2
+    python benchmark.py lookup all
+    python benchmark.py emission all
+    python benchmark.py storage all
+    python benchmark.py beam all
+    python benchmark.py predecessors all
+    python benchmark.py suite all --baseline baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from preprocess import Preprocessor, read_sentences, format_labels
+from emission import Emission
+from transition import Transition
+from transitionOrder2 import Transition2
+from compiled_hmm import CompiledHMM
+from evaluateResult import evaluate
+import viterbi
+import viterbiOrder2
+
+# (beam, threshold) settings of the beam benchmark for each order, (None, None) is exact Viterbi
+BEAM_SETTINGS = {
+    1: [(None, None), (8, None), (4, None), (2, None), (1, None), (None, 4.0), (None, 2.0)],
+    2: [(None, None), (64, None), (16, None), (4, None), (1, None), (None, 4.0), (None, 2.0)],
+}
+
+# Densities of the random transitions of the predecessors benchmark
+PREDECESSOR_DENSITIES = (0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.6, 0.75, 1.0)
+
+# Stages timed by the suite benchmark, in order
+STAGES = ("preprocess", "emission", "transition", "transition2", "viterbi", "viterbi2", "evaluate")
+
+
+"""
+@notice Read the first sentences of an unlabelled input file
+@param _inputFile: Location of input file
+@param limit: maximum number of sentences to read, None for all
+@returns list of lists of words
+"""
+def read_dev_sentences(_inputFile, limit=None):
+    return [tokens for tokens, tags in itertools.islice(read_sentences(_inputFile, labelled=False), limit)]
+
+
+"""
+@notice Time the original and the vectorized second order Viterbi decoders on the same sentences
+@param language: EN, CN, FR or SG
+@param limit: number of dev sentences to decode
+@returns dictionary of timings
+"""
+def compare_viterbi2(language, limit=2):
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor("../data/" + language + "/train")
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+        transition = Transition2()
+        transition.compute_params(preprocessor)
+    sentences = read_dev_sentences("../data/" + language + "/dev.in", limit)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), np.errstate(divide='ignore'):
+        old_paths = [viterbiOrder2.best_path(transition, emission, sentence)[0] for sentence in sentences]
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = CompiledHMM(emission, transition)
+    new_paths = [viterbiOrder2.fast_best_path(transition, emission, sentence, model)[0] for sentence in sentences]
+    new_time = time.perf_counter() - start
+
+    tokens = sum(len(sentence) for sentence in sentences)
+    print("{}: {} sentences, {} tokens, {} states".format(language, len(sentences), tokens, len(emission.states)))
+    print("    best_path      {:10.3f}s".format(old_time))
+    print("    fast_best_path {:10.3f}s  ({:.0f}x)".format(new_time, old_time / new_time))
+    print("    identical paths:", old_paths == new_paths)
+    return {"best_path": old_time, "fast_best_path": new_time, "identical": old_paths == new_paths}
+
+
+"""
+@notice Time the mapping of every dev token to its emission matrix column, with list scans and with Emission.word_column
+@param language: EN, CN, FR or SG
+@param limit: number of dev sentences to read, None for all
+@returns dictionary of timings
+"""
+def compare_lookup(language, limit=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor("../data/" + language + "/train")
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+    sentences = read_dev_sentences("../data/" + language + "/dev.in", limit)
+    tokens = [word for sentence in sentences for word in sentence]
+    word_list = emission.get_word_list()
+
+    start = time.perf_counter()
+    old_columns = [word_list.index(word if word in word_list else '#UNK#') for word in tokens]
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_columns = [emission.word_column(word) for word in tokens]
+    new_time = time.perf_counter() - start
+
+    print("{}: {} tokens, {} words in vocabulary".format(language, len(tokens), len(word_list)))
+    print("    list.index  {:10.4f}s".format(old_time))
+    print("    word_column {:10.4f}s  ({:.0f}x)".format(new_time, old_time / new_time))
+    print("    identical columns:", old_columns == new_columns)
+    return {"list.index": old_time, "word_column": new_time, "identical": old_columns == new_columns}
+
+
+"""
+@notice Time estimate_emission_param for every dev token and tag, against re-summing the tag counts on every query
+@param language: EN, CN, FR or SG
+@param limit: number of dev sentences to read, None for all
+@returns dictionary of timings
+"""
+def compare_emission(language, limit=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor("../data/" + language + "/train")
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+    sentences = read_dev_sentences("../data/" + language + "/dev.in", limit)
+    tokens = [word for sentence in sentences for word in sentence]
+    representer = emission.representer
+
+    start = time.perf_counter()
+    old_probs = [emission.count(word, state, smooth) / (sum(representer[state].values()) + (emission.smoothing_param if smooth else 0))
+                 for smooth in (True, False) for word in tokens for state in emission.states]
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_probs = [emission.estimate_emission_param(word, state, smooth)
+                 for smooth in (True, False) for word in tokens for state in emission.states]
+    new_time = time.perf_counter() - start
+
+    print("{}: {} queries".format(language, len(new_probs)))
+    print("    re-summed totals {:10.4f}s".format(old_time))
+    print("    cached totals    {:10.4f}s  ({:.0f}x)".format(new_time, old_time / new_time))
+    print("    identical probabilities:", old_probs == new_probs)
+    return {"re-summed": old_time, "cached": new_time, "identical": old_probs == new_probs}
+
+
+"""
+@notice Compare the memory, build time and decoding time of dense and sparse emission matrices
+@param language: EN, CN, FR or SG
+@param limit: number of dev sentences to decode, None for all
+@returns dictionary of sizes in bytes and timings
+"""
+def compare_storage(language, limit=None):
+    sentences = read_dev_sentences("../data/" + language + "/dev.in", limit)
+    results = {}
+    paths = {}
+    for storage in ("dense", "sparse"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            preprocessor = Preprocessor("../data/" + language + "/train")
+            transition = Transition()
+            transition.compute_params(preprocessor)
+            start = time.perf_counter()
+            emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states(),
+                                sparse=(storage == "sparse"))
+            build_time = time.perf_counter() - start
+        model = CompiledHMM(emission, transition)
+
+        start = time.perf_counter()
+        word_indices, mask = viterbi.index_sentences(model, sentences)
+        paths[storage] = viterbi.batch_best_path(transition, emission, word_indices, mask, model)[0]
+        decode_time = time.perf_counter() - start
+        results[storage] = {"bytes": model.log_emission.nbytes, "build": build_time, "decode": decode_time}
+
+    shape = model.log_emission.shape
+    print("{}: {} states, {} words, {} stored values".format(language, shape[0], shape[1], len(model.log_emission.data)))
+    for storage in ("dense", "sparse"):
+        print("    {:6} {:8.2f} MB  build {:7.4f}s  decode {:7.4f}s".format(
+            storage, results[storage]["bytes"] / 1024 ** 2, results[storage]["build"], results[storage]["decode"]))
+    print("    identical paths:", paths["dense"] == paths["sparse"])
+    results["identical"] = paths["dense"] == paths["sparse"]
+    return results
+
+
+"""
+@notice Compare the decoding speed and F scores of exact Viterbi with beam search, for both orders. Every setting
+        labels the first dev sentences and is scored against the same sentences of dev.out with evaluate.
+@param language: EN, CN, FR or SG
+@param limit: number of dev sentences to label, None for all
+@returns dictionary of order to a list of (beam, threshold, seconds, entity F, entity type F)
+"""
+def compare_beam(language, limit=None):
+    output_dir = tempfile.mkdtemp()
+    output_file = os.path.join(output_dir, "dev.p.out")
+    # The labelling and scoring functions read files, so the first sentences are written to files of their own
+    dev_file = os.path.join(output_dir, "dev.in")
+    gold_file = os.path.join(output_dir, "dev.out")
+    with open(dev_file, "w", encoding="UTF-8") as f:
+        f.write("".join("\n".join(sentence) + "\n\n" for sentence in read_dev_sentences("../data/" + language + "/dev.in", limit)))
+    gold = list(itertools.islice(read_sentences("../data/" + language + "/dev.out"), limit))
+    with open(gold_file, "w", encoding="UTF-8") as f:
+        f.write(format_labels([tokens for tokens, tags in gold], [tags for tokens, tags in gold]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor("../data/" + language + "/train")
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+
+    results = {}
+    print("{}: {} states".format(language, len(emission.states)))
+    print("    {:5} {:>6} {:>9} {:>9} {:>10} {:>9}".format("order", "beam", "threshold", "seconds", "entity F", "type F"))
+    for order, module, transition in ((1, viterbi, Transition()), (2, viterbiOrder2, Transition2())):
+        with contextlib.redirect_stdout(io.StringIO()):
+            transition.compute_params(preprocessor)
+            model = CompiledHMM(emission, transition)
+        results[order] = []
+        for beam, threshold in BEAM_SETTINGS[order]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                module.label_viterbi(dev_file, output_file, None, None, model=model, beam=beam, threshold=threshold)
+                seconds = time.perf_counter() - start
+                scores = evaluate(gold_file, output_file)
+            results[order].append((beam, threshold, seconds, scores["entity"]["f"], scores["entity_type"]["f"]))
+            print("    {:5d} {:>6} {:>9} {:9.4f} {:10.4f} {:9.4f}".format(
+                order, "all" if beam is None else beam, "-" if threshold is None else threshold,
+                seconds, scores["entity"]["f"], scores["entity_type"]["f"]))
+    for path in (output_file, dev_file, gold_file):
+        os.remove(path)
+    os.rmdir(output_dir)
+    return results
+
+
+"""
+@notice Compare decoding over the allowed predecessors of each state with the dense broadcast, for both orders, on
+        the transitions seen in the train data and on random ones of each density of PREDECESSOR_DENSITIES.
+        The thresholds of viterbi.PREDECESSOR_DENSITY come from this benchmark.
+@param language: EN, CN, FR or SG
+@param limit: number of dev sentences to decode, None for all
+@param repeat: number of runs of each decoder, the fastest is kept
+@returns dictionary of order to a list of (density, dense seconds, sparse seconds, identical paths), identical is
+         None for random transitions, which the sparse decoder does not score as the dense one
+"""
+def compare_predecessors(language, limit=None, repeat=5):
+    sentences = read_dev_sentences("../data/" + language + "/dev.in", limit)
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor("../data/" + language + "/train")
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+    rng = np.random.default_rng(0)
+    thresholds = dict(viterbi.PREDECESSOR_DENSITY)
+
+    def decode(module, model, word_indices, mask, density):
+        # use_predecessors reads the threshold when decoding, 0 always gives the dense broadcast and 1 the predecessors
+        viterbi.PREDECESSOR_DENSITY[model.order] = density
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            paths = module.batch_best_path(None, None, word_indices, mask, model)[0]
+            best = min(best, time.perf_counter() - start)
+        return best, paths
+
+    results = {}
+    print("{}: {} states, {} sentences".format(language, len(emission.states), len(sentences)))
+    print("    {:5} {:>12} {:>9} {:>9} {:>7} {:>9}".format("order", "transitions", "dense", "sparse", "ratio", "identical"))
+    try:
+        for order, module, transition in ((1, viterbi, Transition()), (2, viterbiOrder2, Transition2())):
+            with contextlib.redirect_stdout(io.StringIO()):
+                transition.compute_params(preprocessor)
+            model = CompiledHMM(emission, transition)
+            word_indices, mask = viterbi.index_sentences(model, sentences)
+            seen = transition.allowed_transitions().reshape(model.log_transition.shape)
+            results[order] = []
+            for name, density in [("seen", None)] + [(None, density) for density in PREDECESSOR_DENSITIES]:
+                allowed = seen if density is None else rng.random(seen.shape) < density
+                # Only the speed is compared, so the predecessors do not have to match the transition probabilities
+                model._set_predecessors(allowed)
+                density = allowed.mean()
+                dense_time, dense_paths = decode(module, model, word_indices, mask, 0)
+                sparse_time, sparse_paths = decode(module, model, word_indices, mask, 1)
+                identical = dense_paths == sparse_paths if name else None
+                results[order].append((density, dense_time, sparse_time, identical))
+                print("    {:5d} {:>12} {:9.4f} {:9.4f} {:7.2f} {:>9}".format(
+                    order, "{} {:.2f}".format(name, density) if name else "{:.2f}".format(density),
+                    dense_time, sparse_time, sparse_time / dense_time, "-" if identical is None else str(identical)))
+    finally:
+        viterbi.PREDECESSOR_DENSITY.update(thresholds)
+    return results
+
+
+"""
+@notice Time a function, keeping the fastest of several runs, then measure the peak memory it allocates in one
+        more run. The memory run is traced on its own with tracemalloc, which also traces NumPy arrays, so it only
+        counts what the function allocates and tracing does not slow down the timed runs.
+@param function: function to time, given the result of setup
+@param repeat: number of timed runs
+@param setup: function called before every run and not measured, its result is given to function
+@returns (float, float, object) fastest time in seconds, peak memory allocated in MB and the result of the last run
+"""
+def time_stage(function, repeat, setup=None):
+    best = float("inf")
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(argument) if setup is not None else function()
+        best = min(best, time.perf_counter() - start)
+
+    argument = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function(argument) if setup is not None else function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak / 1024 ** 2, result
+
+
+"""
+@notice Time every stage of training, decoding and evaluating one language
+@param language: EN, CN, FR or SG
+@param repeat: number of runs of each stage, the fastest is kept
+@returns dictionary of stage to its seconds, tokens, tokens/sec and the peak memory it allocates in MB
+"""
+def benchmark_language(language, repeat=3):
+    train_file = "../data/" + language + "/train"
+    dev_file = "../data/" + language + "/dev.in"
+    gold_file = "../data/" + language + "/dev.out"
+    results = {}
+
+    def record(stage, seconds, peak_mb, tokens):
+        results[stage] = {"seconds": seconds, "tokens": tokens, "tokens_per_sec": tokens / seconds if seconds > 0 else None,
+                          "peak_mb": peak_mb}
+
+    seconds, peak_mb, preprocessor = time_stage(lambda: Preprocessor(train_file), repeat)
+    train_tokens = len(preprocessor.word_buffer)
+    dev_tokens = sum(len(sentence) for sentence in read_dev_sentences(dev_file))
+    record("preprocess", seconds, peak_mb, train_tokens)
+
+    # Emission adds #UNK# to the counts it is given, so every run gets its own copy
+    def counts():
+        representer = {state: dict(words) for state, words in preprocessor.get_representer().items()}
+        return representer, dict(preprocessor.get_vocabulary())
+
+    seconds, peak_mb, emission = time_stage(lambda c: Emission(c[0], c[1], c[0].keys()), repeat, setup=counts)
+    record("emission", seconds, peak_mb, train_tokens)
+
+    transitions = {}
+    for stage, transition_class in (("transition", Transition), ("transition2", Transition2)):
+        seconds, peak_mb, transitions[stage] = time_stage(lambda t: t.compute_params(preprocessor) or t, repeat, setup=transition_class)
+        record(stage, seconds, peak_mb, train_tokens)
+
+    output_dir = tempfile.mkdtemp()
+    for stage, module, transition in (("viterbi", viterbi, transitions["transition"]), ("viterbi2", viterbiOrder2, transitions["transition2"])):
+        output_file = os.path.join(output_dir, stage + ".out")
+        seconds, peak_mb, _ = time_stage(lambda: module.label_viterbi(dev_file, output_file, emission, transition), repeat)
+        record(stage, seconds, peak_mb, dev_tokens)
+
+    seconds, peak_mb, _ = time_stage(lambda: evaluate(gold_file, os.path.join(output_dir, "viterbi2.out")), repeat)
+    record("evaluate", seconds, peak_mb, dev_tokens)
+    for stage in ("viterbi", "viterbi2"):
+        os.remove(os.path.join(output_dir, stage + ".out"))
+    os.rmdir(output_dir)
+    return results
+
+
+"""
+@notice Find the stages that got slower than the baseline by more than threshold
+@param results: dictionary of language to stage results, see benchmark_language
+@param baseline: results of an earlier run, in the same format
+@param threshold: allowed slowdown, 0.2 for 20%
+@returns list of (language, stage, seconds, baseline seconds)
+"""
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for language, stages in results.items():
+        for stage, result in stages.items():
+            previous = baseline.get(language, {}).get(stage)
+            if previous is not None and result["seconds"] > previous["seconds"] * (1 + threshold):
+                regressions.append((language, stage, result["seconds"], previous["seconds"]))
+    return regressions
+
+
+"""
+@notice Run the stage benchmarks of every language, compare them to the baseline file and save a new baseline
+@param languages: list of languages
+@param baseline_file: JSON file of an earlier run, None to skip the comparison
+@param threshold: allowed slowdown, 0.2 for 20%
+@param repeat: number of runs of each stage, the fastest is kept
+@param save: boolean indicating whether to write the results to baseline_file, it is always written when it does not exist
+@returns list of regressions, see find_regressions
+"""
+def benchmark_suite(languages, baseline_file=None, threshold=0.2, repeat=3, save=False):
+    baseline = {}
+    if baseline_file is not None and os.path.exists(baseline_file):
+        with open(baseline_file, encoding="UTF-8") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for language in languages:
+        results[language] = benchmark_language(language, repeat)
+        print("{}:".format(language))
+        print("    {:12} {:>9} {:>9} {:>13} {:>12} {:>9}".format("stage", "seconds", "tokens", "tokens/sec", "peak MB", "change"))
+        for stage in STAGES:
+            result = results[language][stage]
+            previous = baseline.get(language, {}).get(stage)
+            change = "" if previous is None else "{:+.0%}".format(result["seconds"] / previous["seconds"] - 1)
+            print("    {:12} {:9.4f} {:9d} {:13.0f} {:12.1f} {:>9}".format(
+                stage, result["seconds"], result["tokens"], result["tokens_per_sec"] or 0, result["peak_mb"], change))
+
+    regressions = find_regressions(results, baseline, threshold)
+    for language, stage, seconds, previous in regressions:
+        print("REGRESSION {} {}: {:.4f}s, baseline {:.4f}s (threshold {:.0%})".format(language, stage, seconds, previous, threshold))
+    if baseline and not regressions:
+        print("No regressions beyond {:.0%} of the baseline.".format(threshold))
+
+    if baseline_file is not None and (save or not os.path.exists(baseline_file)):
+        # Keep the languages of the old baseline that were not run this time
+        baseline.update(results)
+        with open(baseline_file, "w", encoding="UTF-8") as f:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                       "repeat": repeat, "results": baseline}, f, indent=2)
+        print("Saved baseline to", baseline_file)
+    return regressions
+
+
+def main():
+    languages = ["EN", "FR", "CN", "SG"]
+    benchmarks = {"viterbi2": compare_viterbi2, "lookup": compare_lookup, "emission": compare_emission,
+                  "storage": compare_storage, "beam": compare_beam, "predecessors": compare_predecessors}
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", help=", ".join(benchmarks) + " or suite")
+    parser.add_argument("language", help="EN, CN, FR, SG or all.")
+    parser.add_argument("--limit", type=int, help="Number of dev sentences to use, 2 for viterbi2 and all for the others "
+                                                  "by default. Not used by suite, which always times the whole files.")
+    parser.add_argument("--baseline", help="suite: JSON baseline to compare against, written if it does not exist.")
+    parser.add_argument("--save", action="store_true", help="suite: overwrite the baseline with this run.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="suite: slowdown reported as a regression, 0.2 for 20%%.")
+    parser.add_argument("--repeat", type=int, default=3, help="suite: runs of each stage, the fastest is kept.")
+    args = parser.parse_args()
+
+    if args.benchmark != 'suite' and args.benchmark not in benchmarks:
+        raise ValueError('Invalid benchmark selected.')
+    if args.benchmark == 'suite' and args.limit is not None:
+        raise ValueError('--limit is not used by suite, its baselines are always timed on the whole files.')
+    if args.language != 'all':
+        if args.language not in languages:
+            raise ValueError('Invalid language selected.')
+        languages = [args.language]
+
+    if args.benchmark == 'suite':
+        regressions = benchmark_suite(languages, args.baseline, args.threshold, args.repeat, args.save)
+        sys.exit(1 if regressions else 0)
+
+    for language in languages:
+        if args.limit is None:
+            benchmarks[args.benchmark](language)
+        else:
+            benchmarks[args.benchmark](language, args.limit)
+
+
+if __name__ == "__main__":
+    main()
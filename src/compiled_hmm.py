@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only log-space parameters of a trained Hidden Markov Model, shared by the decoders.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from transition import bio_transitions
+from transitionOrder2 import Transition2, SMOOTHING
+from sparse_columns import SparseColumns
+from profiler import PROFILER
+
+# Version of the directory layout written by CompiledHMM.save, bump it whenever the layout changes
+# Version 2 adds sparse emission tables, version 1 models are still loaded
+FORMAT_VERSION = 2
+
+# Tables saved as one .npy file each, so that they can be memory-mapped on load
+TABLES = ('log_emission', 'log_start', 'log_start_u', 'log_transition', 'log_stop')
+
+# Arrays of a sparse log_emission, saved as log_emission.<name>.npy
+SPARSE_PARTS = ('data', 'indices', 'indptr', 'default')
+
+# Factor of the probability of unseen transitions breaking BIO constraints in a model compiled with bio, so that
+# they are as unlikely as two unseen transitions. They are not forbidden: a word only seen with I-X has
+# probability 0 under B-X, and forbidding O -> I-X then leaves no better path than a wrong one.
+BIO_PENALTY = SMOOTHING
+
+
+class CompiledHMM(object):
+    """Class CompiledHMM.
+
+    The CompiledHMM class takes the log of the emission and transition parameters once, so that decoding
+    a file does not repeat it for every sentence. All tables are contiguous read-only arrays and the
+    object cannot be modified after it is built. Build a new one if the Emission or Transition changes.
+
+    A CompiledHMM can be saved to a directory and loaded back without the training data. Loaded tables are
+    memory-mapped, so loading is fast and worker processes share the same pages.
+
+    The transitions seen in the train data are also kept as lists of allowed predecessors of each state, so
+    the decoders can skip the transitions that cannot happen. With bio, the smoothed transitions breaking BIO
+    constraints, such as (B-NP, O) -> I-NP, have their probability multiplied by BIO_PENALTY.
+
+    Attributes:
+        order: 0 for an emission only model, 1 for Transition and 2 for Transition2
+        states: tuple of tags, in the row order of the tables
+        tag_index: dictionary of tag to row
+        word_list: tuple of words, in the column order of log_emission
+        word_index: dictionary of word to column
+        unk: column of #UNK#
+        log_emission: array(states, words) of log emission probabilities, SparseColumns for a sparse Emission
+        log_start: array(states) of log probabilities of START -> v
+        log_start_u: array(states, states) of log probabilities of (START, u) -> v, order 2 only
+        log_transition: array(states, states) of u -> v, or array(states, states, states) of (t, u) -> v
+        log_stop: array(states) of u -> STOP, or array(states, states) of (u, v) -> STOP
+        predecessors: SparseColumns of the allowed entries of log_transition, with a column for each state v
+                      listing the states u with an allowed u -> v (order 1), or a column for each pair (u, v)
+                      listing the states t with a seen (t, u) -> v (order 2). None for order 0.
+        predecessor_columns: array of the column of every stored entry of predecessors
+        log_floor: array(states, states) of the log probability of every (t, u) -> v not in predecessors, -inf
+                   where there is none (order 2 only). Seen transitions are more likely than the smoothed ones.
+    """
+
+    def __init__(self, emission, transition=None, dtype=np.float64, bio=False):
+        with PROFILER.stage('log_transform'):
+            self._compile(emission, transition, dtype, bio)
+
+    def _compile(self, emission, transition, dtype, bio):
+        states = tuple(emission.states)
+        n = len(states)
+        self._set_vocabulary(states, emission.get_word_list(), dict(emission.get_word_index()))
+
+        log_start, log_start_u, log_transition, log_stop = None, None, None, None
+
+        # Use log-likelihoods to avoid floating-point underflow. Ignore -inf.
+        with np.errstate(divide='ignore'):
+            emission_matrix = emission.get_emission_param_matrix()
+            if isinstance(emission_matrix, SparseColumns):
+                log_emission = emission_matrix.map(np.log10)
+            else:
+                log_emission = np.log10(emission_matrix)
+
+            if transition is None:
+                order = 0
+            elif isinstance(transition, Transition2):
+                order = 2
+                log_start = np.log10(transition.get_start_words())
+                log_start_u = np.log10(transition.get_start_u_matrix())
+                log_transition = np.log10(transition.get_transition_matrix()).reshape(n, n, n)
+                log_stop = np.log10(transition.get_stop_words()).reshape(n, n)
+            else:
+                order = 1
+                log_start = np.log10(transition.get_start_words())
+                log_transition = np.log10(transition.get_transition_matrix())
+                log_stop = np.log10(transition.get_stop_words())
+
+        # Transitions seen in the train data keep their probability, the train data does break BIO constraints.
+        # Order 1 and the starts of order 2 give unseen transitions probability 0 already, so only the smoothed
+        # (t, u) -> v of order 2 change.
+        if bio and order == 2:
+            unseen = (transition.transition_count == 0).reshape(n, n, n)
+            log_transition[unseen & ~bio_transitions(states)[np.newaxis, :, :]] += np.log10(BIO_PENALTY)
+
+        self._set('order', order)
+        self._set('log_emission', self._freeze(log_emission, dtype))
+        self._set('log_start', self._freeze(log_start, dtype))
+        self._set('log_start_u', self._freeze(log_start_u, dtype))
+        self._set('log_transition', self._freeze(log_transition, dtype))
+        self._set('log_stop', self._freeze(log_stop, dtype))
+        if order > 0:
+            self._set_predecessors(transition.allowed_transitions().reshape(self.log_transition.shape))
+        else:
+            self._set_predecessors(None)
+
+    """
+    @notice Build predecessors and log_floor from the allowed transitions
+    @param allowed: boolean array in the shape of log_transition, None for order 0
+    """
+    def _set_predecessors(self, allowed):
+        predecessors, log_floor = None, None
+        if allowed is not None:
+            n = len(self.states)
+            # Column of each entry is the state v (order 1) or the pair (u, v) (order 2), its row the state before
+            rows, columns = np.nonzero(allowed.reshape(n, -1))
+            predecessors = self._freeze(SparseColumns.from_entries(
+                rows, columns, self.log_transition.reshape(n, -1)[rows, columns], np.full(n, -np.inf),
+                (n, allowed.reshape(n, -1).shape[1])), self.log_transition.dtype)
+            if self.order == 2:
+                # Transitions (t, u) -> v that were not seen all have the same smoothed probability, BIO_PENALTY
+                # included, so the largest one is the probability of each of them
+                log_floor = np.where(allowed, -np.inf, self.log_transition).max(axis=0)
+                log_floor = self._freeze(log_floor, self.log_transition.dtype)
+        self._set('predecessors', predecessors)
+        self._set('predecessor_columns', None if predecessors is None else
+                  self._freeze(np.repeat(np.arange(predecessors.shape[1]), np.diff(predecessors.indptr)), np.int64))
+        self._set('log_floor', log_floor)
+
+    def _set_vocabulary(self, states, word_list, word_index):
+        self._set('states', tuple(states))
+        self._set('tag_index', {state: i for i, state in enumerate(self.states)})
+        self._set('word_list', tuple(word_list))
+        self._set('word_index', word_index)
+        self._set('unk', self.word_index['#UNK#'])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledHMM is read-only, build a new one instead.")
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def _freeze(self, array, dtype):
+        if array is None:
+            return None
+        if isinstance(array, SparseColumns):
+            return SparseColumns(self._freeze(array.data, dtype), self._freeze(array.indices, array.indices.dtype),
+                                 self._freeze(array.indptr, array.indptr.dtype), self._freeze(array.default, dtype),
+                                 array.shape)
+        array = np.ascontiguousarray(array, dtype=dtype)
+        array.flags.writeable = False
+        return array
+
+    """
+    @notice Map the words of a sentence to columns of log_emission, unseen words are mapped to #UNK#
+    @param sentence: list of words
+    @returns list of int
+    """
+    def index(self, sentence):
+        word_index = self.word_index
+        unk = self.unk
+        return [word_index.get(word, unk) for word in sentence]
+
+    """
+    @notice Map a word to its column of log_emission, unseen words are mapped to #UNK#
+    @param word: string
+    @returns int
+    """
+    def word_column(self, word):
+        return self.word_index.get(word, self.unk)
+
+    """
+    @notice Get the tag with the highest emission probability for a column of log_emission
+    @param word: column of log_emission
+    @returns string
+    """
+    def best_tag(self, word):
+        return self.states[np.argmax(self.log_emission[:, word])]
+
+    """
+    @notice Save the model to a directory: model.json holds the format version, order, tags and words, and every
+            table is written to its own .npy file
+    @param path: directory to save to, created if it does not exist
+    """
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        tables = [name for name in TABLES if getattr(self, name) is not None]
+        for name in tables:
+            if isinstance(getattr(self, name), SparseColumns):
+                for part in SPARSE_PARTS:
+                    np.save(os.path.join(path, name + '.' + part + '.npy'), getattr(getattr(self, name), part))
+            else:
+                np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+        # model.json is written last, a directory without it is not a complete model
+        header = {
+            'format_version': FORMAT_VERSION,
+            'order': self.order,
+            'dtype': self.log_emission.dtype.name,
+            'tables': tables,
+            'sparse_emission': isinstance(self.log_emission, SparseColumns),
+            'states': list(self.states),
+            'words': list(self.word_list),
+        }
+        with open(os.path.join(path, 'model.json'), 'w', encoding='UTF-8') as f:
+            json.dump(header, f, ensure_ascii=False)
+
+    """
+    @notice Load a model written by save. The tables are memory-mapped read-only instead of being read into memory.
+    @param path: directory the model was saved to
+    @param mmap_mode: mode given to np.load, None to read the tables into memory
+    @returns CompiledHMM
+    """
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with PROFILER.stage('load'):
+            return cls._load(path, mmap_mode)
+
+    @classmethod
+    def _load(cls, path, mmap_mode):
+        with open(os.path.join(path, 'model.json'), encoding='UTF-8') as f:
+            header = json.load(f)
+        if header.get('format_version') not in (1, FORMAT_VERSION):
+            raise ValueError("Model at {} has format version {}, expected {}.".format(
+                path, header.get('format_version'), FORMAT_VERSION))
+
+        model = cls.__new__(cls)
+        word_list = header['words']
+        # The first occurrence of a word owns its column, as in Emission
+        word_index = {word: i for i, word in reversed(list(enumerate(word_list)))}
+        model._set_vocabulary(header['states'], word_list, word_index)
+        model._set('order', header['order'])
+        for name in TABLES:
+            table = None
+            if name == 'log_emission' and header.get('sparse_emission', False):
+                parts = [np.load(os.path.join(path, name + '.' + part + '.npy'), mmap_mode=mmap_mode) for part in SPARSE_PARTS]
+                table = SparseColumns(*parts, shape=(len(model.states), len(word_list)))
+            elif name in header['tables']:
+                table = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+            model._set(name, model._freeze(table, np.dtype(header['dtype'])))
+
+        # Seen transitions have a higher probability than the smoothed ones, which are SMOOTHING at most
+        allowed = None
+        if model.order == 1:
+            allowed = np.isfinite(model.log_transition)
+        elif model.order == 2:
+            allowed = model.log_transition > np.asarray(np.log10(SMOOTHING), dtype=model.log_transition.dtype)
+        model._set_predecessors(allowed)
+        return model
+
+    """
+    @notice Check whether a directory holds a complete saved model
+    @param path: directory
+    @returns boolean
+    """
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, 'model.json'))
+
+    """
+    @notice Memory used by the log tables
+    @returns int number of bytes
+    """
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in TABLES if getattr(self, name) is not None)
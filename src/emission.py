@@ -5,7 +5,12 @@ Created on Tue Nov 13 21:31:00 2018
 @author: Keshik
 """
 
+import time
 import numpy as np
+from compiled_hmm import CompiledHMM
+from sparse_columns import SparseColumns
+from pipeline import label_file
+from profiler import PROFILER
 
 class Emission:
     """Class Emission.
@@ -21,17 +26,27 @@ class Emission:
         vocabulary: A dictionary of tokens and their counts generated for the entire document
         states: List to store all possible tags
         smoothing_param: Numeric parameter for smoothing
-        matrix: array(states, words) of emission probabilities
+        matrix: array(states, words) of emission probabilities, SparseColumns if sparse
+        sparse: boolean indicating whether matrix only stores the probabilities of seen (tag, word) pairs
+        matrix_buffer: array(states, capacity) that matrix is the first columns of, grown in chunks by update
         word_list: ordered list of words from vocabulary
+        word_index: dictionary of word to its column in matrix
+        totals: dictionary of tag to its number of tokens
+        smoothed_totals: dictionary of tag to its number of tokens plus the smoothing parameter
     """
 
-    def __init__(self, _representer, _vocabulary, _states, _smoothing_param = 1):
+    def __init__(self, _representer, _vocabulary, _states, _smoothing_param = 1, sparse = False):
         self.representer = _representer
         self.vocabulary = _vocabulary
         self.states = _states
         self.smoothing_param = _smoothing_param
+        self.sparse = sparse
         self.matrix = []
+        self.matrix_buffer = None
         self.word_list = list(self.vocabulary.keys())
+        self.word_index = {}
+        self.totals = {}
+        self.smoothed_totals = {}
 
         self.calc_emission_param_matrix()
 
@@ -42,10 +57,16 @@ class Emission:
     @returns int
     """
     def count_total(self, state, smooth=True):
-        words_dict = self.representer[state]
         if smooth == True:  
-            return sum(words_dict.values()) + self.smoothing_param
-        return sum(words_dict.values())
+            return self.smoothed_totals[state]
+        return self.totals[state]
+
+    """ 
+    @notice Recount the total number of tokens of every tag, needed whenever the representer changes
+    """
+    def calc_totals(self):
+        self.totals = {state: sum(self.representer[state].values()) for state in self.states}
+        self.smoothed_totals = {state: total + self.smoothing_param for state, total in self.totals.items()}
 
     """ 
     @notice Get the number of tokens for a given tag
@@ -71,6 +92,7 @@ class Emission:
     """
     def setSmoothingParam(self, _k):
         self.smoothing_param = _k
+        self.smoothed_totals = {state: total + self.smoothing_param for state, total in self.totals.items()}
 
     """ 
     @notice Get the emission paramter for a token given a tag
@@ -90,95 +112,278 @@ class Emission:
     """
     def calc_emission_param_matrix(self, smooth=True):
         print("Building emission parameter matrix...")
-        emission_matrix = []
         if smooth:
             self.word_list.append('#UNK#')
             self.vocabulary['#UNK#'] = len(self.states)
             for state in self.states:
                 self.representer[state]['#UNK#'] = 1
-        for state in self.states:
-            row = []
-            for word in self.word_list:
-                row.append(self.estimate_emission_param(word, state, True))
-            emission_matrix.append(row)
-        self.matrix = np.array(emission_matrix)
+        self.word_index = {word: i for i, word in reversed(list(enumerate(self.word_list)))}
+        self.calc_totals()
+
+        if self.sparse:
+            self.calc_sparse_matrix()
+            return
+
+        # Scatter the counts of every tag into one (states, words) array
+        with PROFILER.stage('count'):
+            rows, columns, counts = self.count_entries()
+            totals = np.array([self.count_total(state, True) for state in self.states], dtype=float)
+            count_matrix = np.zeros((len(self.states), len(self.word_list)))
+            count_matrix[rows, columns] = counts
+
+            # #UNK# always gets the smoothing parameter, see count
+            if '#UNK#' in self.word_index:
+                count_matrix[:, self.word_index['#UNK#']] = self.smoothing_param
+
+        # Normalise each row by the smoothed total of its tag
+        with PROFILER.stage('normalize'):
+            self.matrix = count_matrix / totals[:, np.newaxis]
+        self.matrix_buffer = self.matrix
         print("Calculated emission parameter matrix with {} states (rows) and {} words (columns).".format(self.matrix.shape[0], self.matrix.shape[1]))
 
+    """
+    @notice Get the count of every (tag, word) pair of the representer
+    @returns (list, list, list) row, column and count of each pair
+    """
+    def count_entries(self):
+        rows, columns, counts = [], [], []
+        for row, state in enumerate(self.states):
+            words_dict = self.representer[state]
+            rows.extend([row] * len(words_dict))
+            columns.extend(self.word_index[word] for word in words_dict)
+            counts.extend(words_dict.values())
+        return rows, columns, counts
+
+    """
+    @notice Calculates the emission param matrix as SparseColumns, only keeping the seen (tag, word) pairs.
+            Every other pair has probability 0.
+    """
+    def calc_sparse_matrix(self):
+        with PROFILER.stage('count'):
+            rows, columns, counts = self.count_entries()
+            rows, columns, counts = np.array(rows, dtype=int), np.array(columns, dtype=int), np.array(counts, dtype=float)
+            totals = np.array([self.count_total(state, True) for state in self.states], dtype=float)
+            shape = (len(self.states), len(self.word_list))
+
+            # #UNK# always gets the smoothing parameter, see count
+            if '#UNK#' in self.word_index:
+                unk = self.word_index['#UNK#']
+                seen = columns != unk
+                rows = np.concatenate([rows[seen], np.arange(len(self.states))])
+                columns = np.concatenate([columns[seen], np.full(len(self.states), unk)])
+                counts = np.concatenate([counts[seen], np.full(len(self.states), self.smoothing_param, dtype=float)])
+
+        # Normalise each value by the smoothed total of its tag
+        with PROFILER.stage('normalize'):
+            self.matrix = SparseColumns.from_entries(rows, columns, counts / totals[rows], np.zeros(len(self.states)), shape)
+        print("Calculated sparse emission parameter matrix with {} states (rows) and {} words (columns), {} stored values.".format(shape[0], shape[1], len(self.matrix.data)))
+
+    """
+    @notice Add new labelled sentences to the counts without recounting the train data. New words get new columns,
+            and only the rows of the tags in the sentences are normalised again. A dense matrix grows into a
+            buffer with spare columns, so adding a few words at a time does not copy the matrix every time.
+            A sparse matrix is rebuilt from the counts. Build a new CompiledHMM after updating.
+    @param sentences: iterable of (tokens, tags), as given by read_sentences
+    @returns None
+    """
+    def update(self, sentences):
+        sentences = list(sentences)
+        for tokens, tags in sentences:
+            for state in tags:
+                if state not in self.representer:
+                    raise ValueError("Tag {} never occurred in train data, retrain to add new tags.".format(state))
+
+        touched = set()
+        for tokens, tags in sentences:
+            for word, state in zip(tokens, tags):
+                if word not in self.vocabulary:
+                    self.vocabulary[word] = 0
+                    self.word_list.append(word)
+                    self.word_index.setdefault(word, len(self.word_list) - 1)
+                self.vocabulary[word] += 1
+                words_dict = self.representer[state]
+                words_dict[word] = words_dict.get(word, 0) + 1
+                self.totals[state] += 1
+                self.smoothed_totals[state] += 1
+                touched.add(state)
+
+        if self.sparse:
+            self.calc_sparse_matrix()
+            return
+
+        self.grow_matrix(len(self.word_list))
+        for row, state in enumerate(self.states):
+            if state in touched:
+                self.matrix[row] = self.row_probabilities(state)
+
+    """
+    @notice Make matrix as wide as the vocabulary, doubling the buffer behind it when it is full. New columns are 0.
+    @param n_words: number of columns needed
+    """
+    def grow_matrix(self, n_words):
+        capacity = self.matrix_buffer.shape[1]
+        if n_words > capacity:
+            buffer = np.zeros((len(self.states), max(n_words, 2 * capacity)))
+            buffer[:, :self.matrix.shape[1]] = self.matrix
+            self.matrix_buffer = buffer
+        self.matrix = self.matrix_buffer[:, :n_words]
+
+    """
+    @notice Calculate the emission parameters of one tag for all words
+    @param state: tag
+    @returns array(words)
+    """
+    def row_probabilities(self, state):
+        words_dict = self.representer[state]
+        row = np.zeros(len(self.word_list))
+        row[[self.word_index[word] for word in words_dict]] = list(words_dict.values())
+        # #UNK# always gets the smoothing parameter, see count
+        if '#UNK#' in self.word_index:
+            row[self.word_index['#UNK#']] = self.smoothing_param
+        return row / self.count_total(state, True)
+
     def get_emission_param_matrix(self):
         return self.matrix
 
     def get_word_list(self):
         return self.word_list
+
+    def get_word_index(self):
+        return self.word_index
+
+    """ 
+    @notice Get the column of a token in the emission matrix, unseen tokens are mapped to #UNK#
+    @param word: token
+    @returns int
+    """
+    def word_column(self, word):
+        if word in self.word_index:
+            return self.word_index[word]
+        return self.word_index['#UNK#']
     
     """ 
-    @notice Given the input file, label the word sequence using the tag that returns the maximum emission probability
+    @notice Given the input file, label the word sequence using the tag that returns the maximum emission probability.
     @param _inputFile: Location of input file
     @param _outputFile: Name of output file to be created
+    @param model: CompiledHMM built from this Emission, built here if not given
+    @param batch_size: number of sentences labelled at once
+    @param workers: number of processes labelling batches in parallel
     @returns None
     """
-    def labelSequence(self, _inputFile, _outputFile):
-        tags = self.states
-        try:
-            tweet_list = open(_inputFile, 'r',  encoding="UTF-8")
-            output_file= open(_outputFile,"w+", encoding="UTF-8")
-            lines = tweet_list.readlines()
-            
-            length = 0
-            for token in lines:
-                if token == "\n":
-                    output_file.write("\n")
-                    continue
-                else:
-                    length = length+1
-                    emission_prob = 0
-                    best_tag = None
-                    for tag in tags:
-                        prob = self.estimate_emission_param(token.strip(), tag, True)
-                        if prob > emission_prob:
-                            #print(prob)
-                            emission_prob = prob
-                            best_tag = tag
-                    
-                    labelled_token = " ".join([token.strip(), best_tag])
-                    output_file.write(labelled_token)
-                    
-                    if (length != len(lines)):
-                        output_file.write("\n")
-
-        except IOError:
-            print(IOError)
-
-        finally:
-            tweet_list.close()
-            output_file.close()
-            print("Sequence Labelling for", _inputFile, "completed. Results are saved in", _outputFile)
-
-
-from preprocess import Preprocessor
+    def labelSequence(self, _inputFile, _outputFile, model=None, batch_size=1000, workers=1):
+        if model is None:
+            model = CompiledHMM(self)
+        label_emission(_inputFile, _outputFile, model, batch_size, workers)
+
+
+"""
+@notice Label the word sequence of the input file using the tag that returns the maximum emission probability.
+        The tokens of each batch of sentences are mapped to their columns at once and tagged with a single argmax
+        over the gathered columns.
+@param _inputFile: Location of input file
+@param _outputFile: Name of output file to be created
+@param model: CompiledHMM built from an Emission, or loaded from disk
+@param batch_size: number of sentences labelled at once
+@param workers: number of processes labelling batches in parallel
+@returns None
+"""
+def label_emission(_inputFile, _outputFile, model, batch_size=1000, workers=1):
+    def decode(batch):
+        return decode_batch(model, batch)
+
+    try:
+        label_file(_inputFile, _outputFile, decode, batch_size, workers=workers)
+
+    except IOError:
+        print(IOError)
+
+    finally:
+        print("Sequence Labelling for", _inputFile, "completed. Results are saved in", _outputFile)
+
+
+"""
+@notice Tag a batch of sentences with the tag that has the maximum emission probability for each token
+@param model: CompiledHMM built from an Emission, or loaded from disk
+@param batch: list of lists of tokens
+@returns list of lists of tags
+"""
+def decode_batch(model, batch):
+    with PROFILER.stage('decode'):
+        start = time.perf_counter()
+        tokens = [word for sentence in batch for word in sentence]
+        columns = model.index(tokens)
+        best_tags = np.argmax(model.log_emission[:, columns], axis=0)
+        paths = split_tags(batch, [model.states[i] for i in best_tags])
+        seconds = time.perf_counter() - start
+    if PROFILER.enabled:
+        count_decoded(model, batch, columns, len(model.states) * len(tokens), seconds)
+    return paths
+
+
+"""
+@notice Add a decoded batch to the sentences, tokens, #UNK# tokens and lattice states counters of the profiler,
+        its decoding time to the decode_batch samples, and the decoding time of each of its sentences to the
+        decode_sentence samples when they were decoded one at a time
+@param model: CompiledHMM used to decode the batch
+@param batch: list of sentences
+@param columns: column of every token of the batch in log_emission
+@param states_explored: number of (position, state) pairs scored while decoding the batch
+@param batch_seconds: seconds taken to decode the batch
+@param sentence_seconds: list of the seconds taken to decode each sentence, None when they were decoded together
+@returns None
+"""
+def count_decoded(model, batch, columns, states_explored, batch_seconds, sentence_seconds=None):
+    PROFILER.count('sentences', len(batch))
+    PROFILER.count('tokens', len(columns))
+    PROFILER.count('unk_tokens', int(np.count_nonzero(np.asarray(columns) == model.unk)))
+    PROFILER.count('states_explored', states_explored)
+    PROFILER.sample('decode_batch', [batch_seconds])
+    if sentence_seconds is not None:
+        PROFILER.sample('decode_sentence', sentence_seconds)
+
+
+"""
+@notice Split the tags of all tokens of a batch of sentences back into one list per sentence
+@param sentences: list of lists of tokens
+@param tags: tag of every token, in order
+@returns list of lists of tags
+"""
+def split_tags(sentences, tags):
+    paths = []
+    start = 0
+    for sentence in sentences:
+        paths.append(tags[start:start + len(sentence)])
+        start += len(sentence)
+    return paths
+
+
 from evaluateResult import evaluate
+from model_cache import ModelCache
 
 
-def train_and_validate_emission(_inputFile, _outputFile, _devFile, _devOutputFile, _validateFile):
+def train_and_validate_emission(_inputFile, _outputFile, _devFile, _devOutputFile, _validateFile, workers=1, model_dir=None, cache=None):
     """
-    Create the Preprocessor object
-    Train using the SG, EN, CN, FR datasets
-    Generate the representer, vocabulary and states and feed it into an Emission object 
+    Load the model saved in model_dir if there is one
+    Otherwise get the model from the cache, which parses and trains on the SG, EN, CN, FR datasets
+    only if they have not been trained on before, and save it to model_dir if given
     """
-    preprocessor = Preprocessor(_inputFile)
-    representer = preprocessor.get_representer()
-    vocabulary = preprocessor.get_vocabulary()
-    states = preprocessor.get_states()
-    
-    
+    if model_dir is not None and CompiledHMM.exists(model_dir):
+        print("Loading saved model from", model_dir)
+        model = CompiledHMM.load(model_dir)
+    else:
+        if cache is None:
+            cache = ModelCache()
+        model = cache.compiled_model(_inputFile, 0)
+        if model_dir is not None:
+            model.save(model_dir)
+
+
     """
-    Create the Emission Object
     Validate using the dev datasets
     Label the input sequence and output the file as dev.p2.out
     """
-    emission = Emission(representer, vocabulary, states)
-    emission.labelSequence(_devFile, _devOutputFile)
-    
-    
+    label_emission(_devFile, _devOutputFile, model, workers=workers)
+
     """
     Calculate Validation Error
     """
@@ -8,148 +8,78 @@ Created on Tue Nov 13 23:24:31 2018
 import sys
 import re
 from copy import copy
-from collections import defaultdict
+from itertools import zip_longest
 from optparse import OptionParser
+from preprocess import read_sentences
+from profiler import PROFILER
 
 
-# Read entities from predcition
-def get_predicted(predicted, answers=defaultdict(lambda: defaultdict(defaultdict))):
-
-    example = 0
-    word_index = 0
-    entity = []
+"""
+@notice Find the entities of a sentence from its tags. An entity starts at a B tag, at an I tag after an O tag or at
+        an I tag with a different sentiment than the tag before it, and continues over the following I tags.
+        Words starting with ## are skipped.
+@param words: list of words
+@param values: list of tags, such as B-positive, I-positive and O
+@returns list of (begin, length, sentiment)
+"""
+def entity_spans(words, values):
+    spans = []
+    entity = None
     last_ne = "O"
     last_sent = ""
-    last_entity = []
-
-    answers[example] = []
-    for line in predicted:
-        line = line.strip()
-        if line.startswith("##"):
-            continue
-        elif len(line) == 0:
-            if entity:
-                answers[example].append(list(entity))
-                entity = []
+    word_index = 0
 
-            example += 1
-            answers[example] = []
-            word_index = 0
-            last_ne = "O"
+    for word, value in zip(words, values):
+        if word.startswith("##"):
             continue
-        else:
-            split_line = line.split(separator)
-            # word = split_line[0]
-            value = split_line[outputColumnIndex]
-            ne = value[0]
-            sent = value[2:]
+        ne = value[0]
+        sent = value[2:]
 
-            last_entity = []
-
-            #check if it is start of entity
-            if ne == 'B' or (ne == 'I' and last_ne == 'O') or (last_ne != 'O' and ne == 'I' and last_sent != sent):
-                if entity:
-                    last_entity = list(entity)
-
-                entity = [sent]
-                    
-                entity.append(word_index)
-
-            elif ne == 'I':
-                entity.append(word_index)
-
-            elif ne == 'O':
-                if last_ne == 'B' or last_ne == 'I':
-                    last_entity =list(entity)
-                entity = []
+        #check if it is start of entity
+        if ne == 'B' or (ne == 'I' and last_ne == 'O') or (last_ne != 'O' and ne == 'I' and last_sent != sent):
+            if entity:
+                spans.append(tuple(entity))
+            entity = [word_index, 1, sent]
 
+        elif ne == 'I':
+            entity[1] += 1
 
-            if last_entity:
-                answers[example].append(list(last_entity))
-                last_entity = []
+        elif ne == 'O':
+            if entity and (last_ne == 'B' or last_ne == 'I'):
+                spans.append(tuple(entity))
+            entity = None
 
         last_sent = sent
         last_ne = ne
         word_index += 1
 
     if entity:
-        answers[example].append(list(entity))
-
-
-    return answers
+        spans.append(tuple(entity))
+    return spans
 
 
+"""
+@notice Read the entities of the gold data and the prediction together, one sentence of each at a time. Each entity
+        is encoded as a (sentence_id, begin, length, sentiment_id) tuple of integers.
+@param observed: iterable of (words, tags) of the gold data
+@param predicted: iterable of (words, tags) of the prediction
+@returns (set, set) entities of the gold data and of the prediction
+"""
+def read_spans(observed, predicted):
+    sentiments = {}
+    observed_spans = set()
+    predicted_spans = set()
 
-#Read entities from gold data
-def get_observed(observed):
-
-
-    example = 0
-    word_index = 0
-    entity = []
-    last_ne = "O"
-    last_sent = ""
-    last_entity = []
-
-    observations=defaultdict(defaultdict)
-    observations[example] = []
-
-    for line in observed:
-        line = line.strip()
-        if line.startswith("##"):
-            continue
-        elif len(line) == 0:
-            if entity:
-                observations[example].append(list(entity))
-                entity = []
-
-            example += 1
-            observations[example] = []
-            word_index = 0
-            last_ne = "O"
+    #A missing sentence in either file has no entities
+    for example, (gold, prediction) in enumerate(zip_longest(observed, predicted, fillvalue=([], []))):
+        if example in discardInstance:
             continue
+        for spans, (words, values) in ((observed_spans, gold), (predicted_spans, prediction)):
+            for begin, length, sent in entity_spans(words, values):
+                spans.add((example, begin, length, sentiments.setdefault(sent, len(sentiments))))
 
-        else:
-            split_line = line.split(separator)
-            word = split_line[0]
-            value = split_line[outputColumnIndex]
-            ne = value[0]
-            sent = value[2:]
-
-
-            last_entity = []
+    return observed_spans, predicted_spans
 
-            #check if it is start of entity, suppose there is no weird case in gold data
-            if ne == 'B' or (ne == 'I' and last_ne == 'O') or (last_ne != 'O' and ne == 'I' and last_sent != sent):
-                if entity:
-                    last_entity = entity
-
-                entity = [sent]
-                    
-                entity.append(word_index)
-
-            elif ne == 'I':
-                entity.append(word_index)
-
-            elif ne == 'O':
-                if last_ne == 'B' or last_ne == 'I':
-                    last_entity = entity
-                entity = []
-
-
-            if last_entity:
-                observations[example].append(list(last_entity))
-                last_entity = []
-
-
-        last_ne = ne
-        last_sent = sent
-        word_index += 1
-
-    if entity:
-        observations[example].append(list(entity))
-
-    return observations
 
 #Print Results and deal with division by 0
 def printResult(evalTarget, num_correct, prec, rec):
@@ -161,92 +91,44 @@ def printResult(evalTarget, num_correct, prec, rec):
     print(evalTarget, ' precision: %.4f' % (prec))
     print(evalTarget, ' recall: %.4f' %   (rec))
     print(evalTarget, ' F: %.4f' % (f))
+    return f
 
 #Compare results bewteen gold data and prediction data
+#observed and predicted are sets of (sentence_id, begin, length, sentiment_id) entities, see read_spans
 def compare_observed_to_predicted(observed, predicted):
 
-    correct_sentiment = 0
-    correct_entity = 0
+    #Count number of entities in gold data and prediction data
+    total_observed = float(len(observed))
+    total_predicted = float(len(predicted))
 
-    total_observed = 0.0
-    total_predicted = 0.0
+    #Entity matched: same sentence, begin and length
+    correct_entity = len({span[:3] for span in observed} & {span[:3] for span in predicted})
 
-    #For each Instance Index example (example = 0,1,2,3.....)
-    for example in observed:
-
-        if example in discardInstance:
-            continue
-
-        observed_instance = observed[example]
-        predicted_instance = predicted[example]
-
-        #Count number of entities in gold data
-        total_observed += len(observed_instance)
-        #Count number of entities in prediction data
-        total_predicted += len(predicted_instance)
-
-        #For each entity in prediction
-        for span in predicted_instance:
-            span_begin = span[1]
-            span_length = len(span) - 1
-            span_ne = (span_begin, span_length)
-            span_sent = span[0]
-
-            #For each entity in gold data
-            for observed_span in observed_instance:
-                begin = observed_span[1]
-                length = len(observed_span) - 1
-                ne = (begin, length)
-                sent = observed_span[0]
-
-                #Entity matched
-                if span_ne == ne:
-                    correct_entity += 1
-
-
-                    #Entity & Sentiment both are matched
-                    if span_sent == sent:
-                        correct_sentiment += 1
+    #Entity & Sentiment both are matched
+    correct_sentiment = len(observed & predicted)
 
     print("Evaluating Validation Error")
     print('#Entity in gold data: %d' % (total_observed))
     print('#Entity in prediction: %d' % (total_predicted))
     print()
 
-    prec = correct_entity/total_predicted
-    rec = correct_entity/total_observed
-    printResult('Entity', correct_entity, prec, rec)
-    print()
-
-    prec = correct_sentiment/total_predicted
-    rec = correct_sentiment/total_observed
-    printResult('Entity Type',correct_sentiment, prec, rec)
-    print()
+    scores = {'observed': int(total_observed), 'predicted': int(total_predicted)}
+    for evalTarget, key, num_correct in (('Entity', 'entity', correct_entity), ('Entity Type', 'entity_type', correct_sentiment)):
+        prec = num_correct/total_predicted if total_predicted else 0.0
+        rec = num_correct/total_observed if total_observed else 0.0
+        f = printResult(evalTarget, num_correct, prec, rec)
+        print()
+        scores[key] = {'correct': num_correct, 'precision': prec, 'recall': rec, 'f': f}
+    return scores
 
 
 
 ##############Main Function##################
-#column separator
-separator = ' '
-
-#the column index for tags
-outputColumnIndex = 1
-
 discardInstance = []
 def evaluate(_file1, _file2):
-    gold = open(_file1, "r", encoding='UTF-8')
-    prediction = open(_file2, "r", encoding='UTF-8')
-    
-    
-
-    #Read Gold data
-    observed = get_observed(gold)
-    
-    #Read Predction data
-    predicted = get_predicted(prediction)
-    
-    #Compare
-    compare_observed_to_predicted(observed, predicted)
-    
-    gold.close()
-    prediction.close()
+    with PROFILER.stage('score'):
+        #Read Gold data and Predction data
+        observed, predicted = read_spans(read_sentences(_file1), read_sentences(_file2))
+
+        #Compare
+        return compare_observed_to_predicted(observed, predicted)
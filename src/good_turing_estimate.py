@@ -34,17 +34,10 @@ class SimpleGoodTuring():
     @return: (r, n) = (np.array, np.array):#individuals in species, count of species with r individuals
     """
     def count_of_counts(self, species, max_count):
-        N_c = dict()
-        for r in range(1, max_count + 1):
-            n = np.sum(np.fromiter(
-                (1 for v in species.values() if v == r), np.int))
-            if n != 0:
-                N_c[r] = n
-        sort_Nc = self._sort_dict(N_c)
-        #print(sort_Nc.keys())
-        r = np.array(list(sort_Nc.keys()), dtype=int)
-        n = np.array(list(sort_Nc.values()), dtype=int)
-        return r, n
+        counts = np.fromiter(species.values(), dtype=int, count=len(species))
+        counts = counts[(counts >= 1) & (counts <= max_count)]
+        r, n = np.unique(counts, return_counts=True)
+        return r.astype(int), n.astype(int)
 
     
     """
@@ -54,18 +47,14 @@ class SimpleGoodTuring():
     @return: np.array, smoothed count of counts
     """
     def Z_smoothing(self, r, n):
-        Z = dict()
         if len(r) == 1:
             return np.array([1,1], dtype=float)
-        Z[r[0]] = 2 * n[0] / r[1]
-        Z[r[-1]] = n[-1] / (r[-1] - r[-2])
-        for idx in range(1, len(r) - 1):
-            j, nj = r[idx], n[idx]
-            i, k = r[idx - 1], r[idx + 1]
-            Z[j] = 2 * nj / (k - i)
-        sort_Z = self._sort_dict(Z)
-        Z_arr = np.array(list(sort_Z.values()), dtype=float)
-        return Z_arr
+        Z = np.empty(len(r), dtype=float)
+        Z[0] = 2 * n[0] / r[1]
+        Z[-1] = n[-1] / (r[-1] - r[-2])
+        # each r between the first and the last is averaged over the gap between its neighbours
+        Z[1:-1] = 2 * n[1:-1] / (r[2:] - r[:-2])
+        return Z
     
     
     """
@@ -103,29 +92,28 @@ class SimpleGoodTuring():
     :return: numpy.array, r* - smoothed counts
     """
     def smooth_counts(self, r, n, S):
-        r_star = np.array(r, dtype=float)
-        cease_x = False
-        for i in np.arange(len(r)):
-            if (r[i] not in np.arange(len(S))):
-                y = y = (r[i] + 1) * S[i] / S[i- 1]
-            else:
-                y = (r[i] + 1) * S[r[i]] / S[r[i] - 1]  # zero index base in python
-                #print("Sr+1 = " + str(S[r[i]]))
-                #print("Sr = " + str(S[r[i] - 1]))
-            
-            x = 0
-            t = float("inf")
-            if i + 1 >= len(r) or r[i + 1] != r[i] + 1:
-                cease_x = True
-            if not cease_x:
-                x = (r[i] + 1) * n[i + 1] / n[i]
-                t = 1.96 * np.sqrt((r[i] + 1) * (r[i] + 1) * n[i + 1] *
-                                   (1 + n[i + 1] / n[i]) / (n[i] * n[i]))
-            if np.abs(x - y) <= t:
-                cease_x = True
-                r_star[i] = y
-            else:
-                r_star[i] = x
+        r = np.asarray(r)
+        n = np.asarray(n)
+        idx = np.arange(len(r))
+
+        # Linear Good-Turing estimate y, S is indexed by r where r is within S
+        in_S = r < len(S)
+        y = (r + 1) * S[np.where(in_S, r, idx)] / S[np.where(in_S, r - 1, idx - 1)]
+
+        # Turing estimate x and its confidence interval t, only defined while r + 1 is also observed
+        consecutive = np.zeros(len(r), dtype=bool)
+        consecutive[:-1] = r[1:] == r[:-1] + 1
+        x = np.zeros(len(r))
+        t = np.full(len(r), float("inf"))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x[:-1] = (r[:-1] + 1) * n[1:] / n[:-1]
+            t[:-1] = 1.96 * np.sqrt((r[:-1] + 1) * (r[:-1] + 1) * n[1:] *
+                                    (1 + n[1:] / n[:-1]) / (n[:-1] * n[:-1]))
+
+        # x is used until the first r where r + 1 is not observed or x is close enough to y, y from there on
+        switch = ~consecutive | (np.abs(x - y) <= t)
+        first_y = np.argmax(switch) if switch.any() else len(r)
+        r_star = np.where(idx < first_y, x, y)
         return r_star
     
     
@@ -152,21 +140,15 @@ class SimpleGoodTuring():
     @return: dict, the probability of any seen species if species_pool is specified the probability of the unseen species is also calculated
     """
     def species_probs(self, species, r, P0, sgt_probs, species_pool=[]):
-        species_sgt = dict()
         if species_pool == None:
             species_pool = []
         if len(species_pool) == 0:
             species_pool = species.keys()
         species_seen = species.keys()
         species_unseen = list(set(species_seen) ^ set(species_pool))
-        for s in species_seen:
-            idx = -1
-            try:
-                idx = np.where(r == species[s])
-            except KeyError:
-                print("Value not found in r table.\n")
-                print("Maybe used different species for computing sgt probs?\n")
-            species_sgt[s] = sgt_probs[idx][0]
+
+        counts = np.fromiter(species.values(), dtype=int, count=len(species))
+        species_sgt = dict(zip(species_seen, self.count_probs(counts, r, sgt_probs).tolist()))
 
         total_unseen = len(species_unseen)
         for s in species_unseen:
@@ -174,6 +156,20 @@ class SimpleGoodTuring():
         return species_sgt
     
     
+    """
+    @notice: Map the count of every species to the probability of its r
+    @param counts: numpy.array, number of individuals of each species
+    @param r: numpy.array
+    @param sgt_probs: numpy.array
+    @return: numpy.array, probability of each species
+    """
+    def count_probs(self, counts, r, sgt_probs):
+        idx = np.searchsorted(r, counts)
+        if np.any(idx >= len(r)) or np.any(r[np.minimum(idx, len(r) - 1)] != counts):
+            raise ValueError("Value not found in r table. Maybe used different species for computing sgt probs?")
+        return sgt_probs[idx]
+    
+    
     """
     @notice: Complete wrapper to compute smoothed probabilites
     @param species_pool: list, all the possible species
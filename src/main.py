@@ -1,8 +1,39 @@
 import argparse
+import os
+from contextlib import contextmanager
 
 from emission import train_and_validate_emission
 from viterbi import train_and_validate_viterbi
 from viterbiOrder2 import train_and_validate_viterbi2
+from model_cache import ModelCache
+from profiler import PROFILER, write_reports
+
+
+def model_path(model_dir, language, part):
+    if model_dir is None:
+        return None
+    return os.path.join(model_dir, language, part)
+
+
+"""
+@notice Profile the stages run in the with block as one report, when profiling. Each model of each language gets
+        its own report, so the decoding counters and rates of different models are not added together.
+@param args: parsed arguments
+@param reports: dictionary of language to a dictionary of model to its report, the report is added to it
+@param language: EN, CN, FR or SG
+@param model: emission, viterbi or viterbi2
+"""
+@contextmanager
+def profile_model(args, reports, language, model):
+    if not args.profile:
+        yield
+        return
+    PROFILER.enable(args.profile_dir)
+    yield
+    PROFILER.print_report(language + " " + model + " Profile")
+    reports.setdefault(language, {})[model] = PROFILER.report()
+    if args.profile_dir is not None:
+        PROFILER.dump_stats(os.path.join(args.profile_dir, language, model))
 
 
 def evaluate():
@@ -12,6 +43,28 @@ def evaluate():
     parser = argparse.ArgumentParser()
     parser.add_argument("language", help="EN, CN, FR, SG or all.")
     parser.add_argument("model", help="emission, viterbi, viterbi2, custom or all.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to label the dev set.")
+    parser.add_argument("--model-dir", default=None,
+                        help="Directory of saved models. Saved models are loaded instead of training, new ones are saved.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory caching trained models across runs, keyed by the training file content.")
+    parser.add_argument("--cache-size", type=int, default=256, help="Maximum size of the cache directory in MB.")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Store emission matrices sparsely, only keeping the probabilities of seen (tag, word) pairs.")
+    parser.add_argument("--bio", action="store_true",
+                        help="Make the unseen transitions of viterbi2 that break BIO constraints, such as (B-NP, O) -> I-NP, "
+                             "less likely than the other unseen ones.")
+    parser.add_argument("--beam", type=int, default=None,
+                        help="Viterbi models only keep this many states (pairs of states for viterbi2) at each word.")
+    parser.add_argument("--beam-threshold", type=float, default=None,
+                        help="Viterbi models drop states whose log10 probability is more than this below the best one at each word.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time every stage and the decoding of every batch, and count tokens, #UNK# tokens and "
+                             "decoded states, reported for each model of each language. Decode times of --workers "
+                             "processes are summed over the workers.")
+    parser.add_argument("--profile-dir", default=None,
+                        help="With --profile, write report.json and the cProfile stats of every stage to this directory. "
+                             "Stages run by --workers processes have no cProfile stats.")
     args = parser.parse_args()
 
     if args.language == 'all':
@@ -24,6 +77,10 @@ def evaluate():
     if args.model not in models:
         raise ValueError('Invalid model selected.')
 
+    # Shared by every model, so each training file is parsed once per run
+    cache = ModelCache(args.cache_dir, args.cache_size * 1024 ** 2, args.sparse, args.bio)
+    reports = {}
+
     for language in languages:
         print("------------------------ " + language + " Training Dataset --------------------------")
         inputFile = "../data/" + str(language) + "/train"
@@ -34,21 +91,27 @@ def evaluate():
             outputFile = "../data/" + str(language) + "/dev.p2.out"
             devOutputFile = "../data/" + str(language) + "/dev.p2.out"
             validateFile = "../data/" + str(language) + "/dev.out"
-            train_and_validate_emission(inputFile, outputFile, devFile, devOutputFile, validateFile)
+            with profile_model(args, reports, language, 'emission'):
+                train_and_validate_emission(inputFile, outputFile, devFile, devOutputFile, validateFile, args.workers,
+                                                model_path(args.model_dir, language, "p2"), cache)
 
         if args.model == 'viterbi' or 'all':
             print("------------------------ " + "Part 3 Viterbi Model --------------------------")
             outputFile = "../data/" + str(language) + "/dev.p3.out"
             devOutputFile = "../data/" + str(language) + "/dev.p3.out"
             validateFile = "../data/" + str(language) + "/dev.out"
-            train_and_validate_viterbi(inputFile, outputFile, devFile, devOutputFile, validateFile)
+            with profile_model(args, reports, language, 'viterbi'):
+                train_and_validate_viterbi(inputFile, outputFile, devFile, devOutputFile, validateFile, args.workers,
+                                               model_path(args.model_dir, language, "p3"), cache, args.beam, args.beam_threshold)
 
         if args.model == 'viterbi2' or 'all':
             print("------------------------ " + "Part 4 Viterbi2 Model --------------------------")
             outputFile = "../data/" + str(language) + "/dev.p4.out"
             devOutputFile = "../data/" + str(language) + "/dev.p4.out"
             validateFile = "../data/" + str(language) + "/dev.out"
-            train_and_validate_viterbi2(inputFile, outputFile, devFile, devOutputFile, validateFile)
+            with profile_model(args, reports, language, 'viterbi2'):
+                train_and_validate_viterbi2(inputFile, outputFile, devFile, devOutputFile, validateFile, args.workers,
+                                                model_path(args.model_dir, language, "p4"), cache, args.beam, args.beam_threshold)
 
         # if args.model == 'custom' or 'all':
         #     print("------------------------ " + "Part 5 Custom Model --------------------------")
@@ -57,6 +120,11 @@ def evaluate():
         #     validateFile = "../data/" + str(language) + "/dev.out"
         #     train_and_validate_custom(inputFile, outputFile, devFile, devOutputFile, validateFile)
 
+    if args.profile and args.profile_dir is not None:
+        os.makedirs(args.profile_dir, exist_ok=True)
+        write_reports(reports, os.path.join(args.profile_dir, "report.json"))
+        print("Profile written to", args.profile_dir)
+
 
 if __name__ == "__main__":
     evaluate()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of trained models, so that a training file is parsed and trained on once.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+from compiled_hmm import CompiledHMM, FORMAT_VERSION, BIO_PENALTY
+
+
+class ModelCache(object):
+    """Class ModelCache.
+
+    The ModelCache class trains each model once per training file. Models are keyed by a fingerprint of the
+    training file content, the model order and the smoothing settings, so an edited training file or a new
+    smoothing parameter gives a new model.
+
+    Within a run the Preprocessor, Emission, Transition and CompiledHMM objects are kept in memory and shared
+    between the models that need them. Given a cache directory, compiled models are also saved to disk and
+    loaded by later runs. The directory is kept under max_bytes by removing the least recently used models,
+    but never the model saved last, so a model larger than max_bytes is still cached.
+    With sparse set, the emission matrices are stored as SparseColumns. With bio set, the compiled models penalise
+    the unseen transitions breaking BIO constraints, see CompiledHMM.
+
+    Attributes:
+        cache_dir: directory of saved models, None to only cache within this run
+        max_bytes: maximum total size of cache_dir
+        sparse: boolean indicating whether to build sparse emission matrices
+        bio: boolean indicating whether to compile models with the BIO penalty
+        fingerprints: dictionary of training file to its (size, mtime, content hash)
+        preprocessors: dictionary of content hash to Preprocessor
+        emissions: dictionary of (content hash, smoothing parameter) to Emission
+        transitions: dictionary of (content hash, order) to Transition or Transition2
+        models: dictionary of cache key to CompiledHMM
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=256 * 1024 ** 2, sparse=False, bio=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.sparse = sparse
+        self.bio = bio
+        self.fingerprints = {}
+        self.preprocessors = {}
+        self.emissions = {}
+        self.transitions = {}
+        self.models = {}
+
+    """
+    @notice Content hash of a training file. The file is only hashed again when its size or mtime changes.
+    @param input_file: Location of training file
+    @returns string
+    """
+    def fingerprint(self, input_file):
+        path = os.path.abspath(input_file)
+        stat = os.stat(path)
+        cached = self.fingerprints.get(path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        self.fingerprints[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+
+    """
+    @notice Key of a compiled model, from the training file content, the model order, the smoothing settings,
+            the emission storage and the BIO penalty
+    @param content_hash: fingerprint of the training file
+    @param order: 0 for the emission only model, 1 for Transition and 2 for Transition2
+    @param smoothing_param: smoothing parameter of the Emission
+    @returns string
+    """
+    def key(self, content_hash, order, smoothing_param):
+        # The BIO penalty stands for bio, so models compiled with another penalty are not loaded
+        settings = json.dumps([FORMAT_VERSION, content_hash, order, smoothing_param, self.sparse, self.bio and BIO_PENALTY])
+        return hashlib.sha256(settings.encode('UTF-8')).hexdigest()
+
+    def preprocessor(self, input_file, content_hash):
+        if content_hash not in self.preprocessors:
+            self.preprocessors[content_hash] = Preprocessor(input_file)
+        return self.preprocessors[content_hash]
+
+    def emission(self, input_file, content_hash, smoothing_param):
+        if (content_hash, smoothing_param) not in self.emissions:
+            preprocessor = self.preprocessor(input_file, content_hash)
+            # Emission adds #UNK# to the counts it is given, so give it a copy of the parsed counts
+            representer = {state: dict(words) for state, words in preprocessor.get_representer().items()}
+            vocabulary = dict(preprocessor.get_vocabulary())
+            self.emissions[(content_hash, smoothing_param)] = Emission(representer, vocabulary, representer.keys(), smoothing_param, self.sparse)
+        return self.emissions[(content_hash, smoothing_param)]
+
+    def transition(self, input_file, content_hash, order):
+        if (content_hash, order) not in self.transitions:
+            transition = Transition2() if order == 2 else Transition()
+            transition.compute_params(self.preprocessor(input_file, content_hash))
+            self.transitions[(content_hash, order)] = transition
+        return self.transitions[(content_hash, order)]
+
+    """
+    @notice Get the compiled model of a training file, from memory, from the cache directory or by training it
+    @param input_file: Location of training file
+    @param order: 0 for the emission only model, 1 for Transition and 2 for Transition2
+    @param smoothing_param: smoothing parameter of the Emission
+    @returns CompiledHMM
+    """
+    def compiled_model(self, input_file, order, smoothing_param=1):
+        content_hash = self.fingerprint(input_file)
+        key = self.key(content_hash, order, smoothing_param)
+        if key in self.models:
+            return self.models[key]
+
+        model = self.load(key)
+        if model is None:
+            emission = self.emission(input_file, content_hash, smoothing_param)
+            transition = self.transition(input_file, content_hash, order) if order > 0 else None
+            model = CompiledHMM(emission, transition, bio=self.bio)
+            self.save(key, model)
+        self.models[key] = model
+        return model
+
+    """
+    @notice Load a model from the cache directory and mark it as recently used
+    @param key: cache key of the model
+    @returns CompiledHMM, None if it is not in the cache directory
+    """
+    def load(self, key):
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, key)
+        if not CompiledHMM.exists(path):
+            return None
+        try:
+            model = CompiledHMM.load(path)
+        except (IOError, ValueError) as e:
+            print("Ignoring unreadable cached model at", path, e)
+            return None
+        os.utime(os.path.join(path, 'model.json'))
+        print("Loaded cached model from", path)
+        return model
+
+    """
+    @notice Save a model to the cache directory, then evict the least recently used models over max_bytes.
+            The model just saved is never evicted, even when it alone is larger than max_bytes.
+    @param key: cache key of the model
+    @param model: CompiledHMM
+    """
+    def save(self, key, model):
+        if self.cache_dir is None:
+            return
+        path = os.path.join(self.cache_dir, key)
+        # Write to a temporary directory first, so other runs never load a partly written model
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        try:
+            model.save(temp_path)
+            os.rename(temp_path, path)
+        except OSError as e:
+            if not CompiledHMM.exists(path):
+                print("Could not cache model at", path, e)
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self.evict(keep=path)
+
+    """
+    @notice Remove the least recently used models until the cache directory is under max_bytes
+    @param keep: directory of a model that is not removed, None to remove any model
+    """
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if '.tmp-' in name or path == keep or not CompiledHMM.exists(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(os.path.join(path, 'model.json')), size, path))
+
+        # The kept model counts towards max_bytes, so the others make room for it
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and CompiledHMM.exists(keep):
+            total += sum(os.path.getsize(os.path.join(keep, f)) for f in os.listdir(keep))
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+from preprocess import Preprocessor
+from emission import Emission
+from transition import Transition
+from transitionOrder2 import Transition2
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Reader -> decoder -> writer pipeline used by the sequence labellers.
+
+The reader streams sentences from the input file, the decoder tags a batch of sentences at a time and
+the writer collects the labelled lines into large blocks before writing them out.
+"""
+
+import multiprocessing
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from preprocess import read_sentences, batch_sentences, format_labels
+from profiler import PROFILER
+
+
+"""
+@notice Decoder stage, tag every batch of sentences
+@param batches: iterable of lists of sentences
+@param decode: function taking a list of sentences and returning a list of paths
+@returns generator of (sentences, paths)
+"""
+def decode_stage(batches, decode):
+    for batch in batches:
+        yield batch, decode(batch)
+
+
+# Decode function of a worker process, set once when the worker starts
+_worker_decode = None
+
+
+def _init_worker(decode):
+    global _worker_decode
+    _worker_decode = decode
+    # The cProfile stats of a worker cannot be sent back, only its timings and counters
+    PROFILER.profile_dir = None
+
+
+def _decode_in_worker(batch):
+    if not PROFILER.enabled:
+        return _worker_decode(batch), None
+    # Only send back what was measured for this batch, the main process adds it up
+    PROFILER.reset()
+    return _worker_decode(batch), PROFILER.snapshot()
+
+
+"""
+@notice Get the paths of a batch decoded by a worker, and add what the worker measured to the profiler
+@param future: Future of _decode_in_worker
+@returns list of paths
+"""
+def _worker_result(future):
+    paths, snapshot = future.result()
+    if snapshot is not None:
+        PROFILER.merge(snapshot)
+    return paths
+
+
+"""
+@notice Decoder stage spread over worker processes. The workers are forked, so decode and the model it uses
+        are inherited once instead of being pickled for every batch. Only the sentences and paths are sent
+        between processes, with the timings and counters of the batch when profiling, and the results are
+        yielded in the original order.
+@param batches: iterable of lists of sentences
+@param decode: function taking a list of sentences and returning a list of paths
+@param workers: number of worker processes
+@returns generator of (sentences, paths)
+"""
+def parallel_decode_stage(batches, decode, workers):
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(decode,)) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, executor.submit(_decode_in_worker, batch)))
+            # Keep a couple of batches per worker in flight so the input is still streamed
+            if len(pending) >= 2 * workers:
+                batch, future = pending.popleft()
+                yield batch, _worker_result(future)
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, _worker_result(future)
+
+
+"""
+@notice Writer stage, format the decoded sentences and write them in blocks of at least block_size characters
+@param output_file: open file to write to
+@param decoded: iterable of (sentences, paths)
+@param block_size: number of characters collected before each write
+@returns (int, int) number of sentences and tokens written
+"""
+def write_stage(output_file, decoded, block_size):
+    block = []
+    size = 0
+    sentences = 0
+    tokens = 0
+    for batch, paths in decoded:
+        with PROFILER.stage('write'):
+            text = format_labels(batch, paths)
+            block.append(text)
+            size += len(text)
+            sentences += len(batch)
+            tokens += sum(len(sentence) for sentence in batch)
+            if size >= block_size:
+                output_file.write("".join(block))
+                block = []
+                size = 0
+    if block:
+        with PROFILER.stage('write'):
+            output_file.write("".join(block))
+    return sentences, tokens
+
+
+"""
+@notice Peak resident set size of this process since it started. It only grows, so it includes the memory of
+        everything the process ran before, not only the last stage.
+@returns float in MB, None where the resource module is not available
+"""
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return rss / 1024 ** 2
+    return rss / 1024
+
+
+"""
+@notice Label an unlabelled input file through the reader, decoder and writer stages
+@param input_file: Location of input file
+@param output_file: Name of output file to be created
+@param decode: function taking a list of sentences and returning a list of paths
+@param batch_size: number of sentences given to decode at once
+@param block_size: number of characters collected before each write
+@param workers: number of processes decoding batches in parallel, 1 to decode in this process
+@returns dictionary with the number of sentences and tokens, the time taken, tokens/sec and the peak RSS
+         of the process so far in MB
+"""
+def label_file(input_file, output_file, decode, batch_size=1000, block_size=1 << 20, workers=1):
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print("Worker processes need the fork start method, labelling in a single process.")
+        workers = 1
+
+    start = time.perf_counter()
+    with open(output_file, "w+", encoding="UTF-8") as output:
+        sentences = (tokens for tokens, tags in read_sentences(input_file, labelled=False))
+        batches = batch_sentences(sentences, batch_size)
+        if workers > 1:
+            decoded = parallel_decode_stage(batches, decode, workers)
+        else:
+            decoded = decode_stage(batches, decode)
+        n_sentences, n_tokens = write_stage(output, decoded, block_size)
+    seconds = time.perf_counter() - start
+
+    stats = {
+        "sentences": n_sentences,
+        "tokens": n_tokens,
+        "seconds": seconds,
+        "tokens_per_sec": n_tokens / seconds if seconds > 0 else float("inf"),
+        "peak_rss_mb": peak_rss(),
+    }
+    rss = "n/a" if stats["peak_rss_mb"] is None else "{:.1f} MB".format(stats["peak_rss_mb"])
+    print("Labelled {} tweets ({} tokens) in {:.3f}s, {:.0f} tokens/sec, process peak RSS {}".format(
+        n_sentences, n_tokens, seconds, stats["tokens_per_sec"], rss))
+    return stats
@@ -5,6 +5,12 @@ Created on Tue Nov 11 20:32:07 2018
 @author: Keshik, Charles
 """
 
+from array import array
+
+import numpy as np
+
+from profiler import PROFILER
+
 
 class Preprocessor:
     """Class Preprocessor.
@@ -12,62 +18,80 @@ class Preprocessor:
     The Preprocessor class reads text input file following the format
     of one token per line with token and tag separated by whitespace and a single
     empty line that separates sentences.
+
+    Words and tags are interned to dense integer ids while reading, in order of first appearance, and the
+    corpus is kept as flat buffers of ids with the offset of each sentence. The counts are computed from the
+    buffers with NumPy once the file is read.
     
     Attributes:
         representer: A dictionary of dictonary indicating the tag and the counts for the tag.
         vocabulary: A dictionary of tokens and their counts generated for the entire document.
-        data:
-        ordered_states:
+        word_ids: dictionary of word to its id
+        tag_ids: dictionary of tag to its id
+        words: list of words, indexed by id
+        tags: list of tags, indexed by id
+        word_buffer: array('i') of the word id of every token, sentence after sentence
+        tag_buffer: array('i') of the tag id of every token, sentence after sentence
+        offsets: array('q') of the start of every sentence in the buffers, followed by the number of tokens
     """
     
     def __init__(self, input_file):
-        self.data = []
-        self.ordered_states = []
+        self.word_ids = {}
+        self.tag_ids = {}
+        self.words = []
+        self.tags = []
+        self.word_buffer = array('i')
+        self.tag_buffer = array('i')
+        self.offsets = array('q', [0])
         self.representer = {}
         self.vocabulary = {}
         self.read_data(input_file)
         
         
     """ 
-    @notice Read data to generate the vocabulary, representer, ordered_states and data 
+    @notice Read data to intern the words and tags into the buffers, then count the vocabulary and representer
     @param line: Location of input file
     @returns None
     """
     def read_data(self, input_file):
+        word_ids = self.word_ids
+        tag_ids = self.tag_ids
         try:
-            tweet_list = open(input_file, encoding = "UTF-8")
-            lines = tweet_list.readlines()
-            sentence = []
-            sentence_labels = []
-
-            for line in lines:
-                if line == '\n':
-                    self.data.append(sentence)
-                    self.ordered_states.append(sentence_labels)
-                    sentence = []
-                    sentence_labels = []
-                    continue
-                else:
-                    word, state = self.process_token(line)
-                    self.update_vocabulary(word)
-                    sentence.append(word)
-                    sentence_labels.append(state)
-                    if state not in self.representer:
-                        word_dict = {word:1}
-                        self.representer[state] = word_dict
-                    else:
-                        if word not in self.representer[state]:
-                            word_dict = {word:1}
-                            self.representer[state].update(word_dict)
-                        else:
-                            self.representer[state][word] = self.representer[state][word] + 1
+            with PROFILER.stage('read'):
+                for sentence, sentence_labels in read_sentences(input_file):
+                    self.word_buffer.extend([word_ids.setdefault(word, len(word_ids)) for word in sentence])
+                    self.tag_buffer.extend([tag_ids.setdefault(state, len(tag_ids)) for state in sentence_labels])
+                    self.offsets.append(len(self.word_buffer))
 
         except IOError:
             print(IOError)
 
         finally:
-            tweet_list.close()
-            print('Data set at {} loaded with {} tweets and {} unique labels.'.format(input_file, len(self.data), len(self.representer)))
+            self.words = list(word_ids)
+            self.tags = list(tag_ids)
+            PROFILER.count('train_sentences', len(self.offsets) - 1)
+            PROFILER.count('train_tokens', len(self.word_buffer))
+            with PROFILER.stage('count'):
+                self.count()
+            print('Data set at {} loaded with {} tweets and {} unique labels.'.format(input_file, len(self.offsets) - 1, len(self.representer)))
+
+    """ 
+    @notice Count every word, and every word for each tag, from the buffers. Words and tags keep their order of
+            first appearance in vocabulary and representer.
+    @returns None
+    """
+    def count(self):
+        words = self.get_word_ids()
+        tags = self.get_tag_ids()
+        n_words = len(self.words)
+        self.vocabulary = dict(zip(self.words, np.bincount(words, minlength=n_words).tolist()))
+
+        # Count each (tag, word) pair, ordered by where the pair first appears
+        pairs, first, counts = np.unique(tags.astype(np.int64) * n_words + words, return_index=True, return_counts=True)
+        order = np.argsort(first, kind='stable')
+        self.representer = {tag: {} for tag in self.tags}
+        for pair, count in zip(pairs[order].tolist(), counts[order].tolist()):
+            self.representer[self.tags[pair // n_words]][self.words[pair % n_words]] = count
 
     """ 
     @notice Process token to generate the word and tag 
@@ -75,25 +99,52 @@ class Preprocessor:
     @returns word (string) and state (string)
     """
     def process_token(self, line):
-        tokens = line.strip().split()
-        state = tokens[-1]
-        word = " ".join(tokens[0:len(tokens)-1])
-        # print(word, state)
-        return word, state
+        return process_token(line)
+
+    """ 
+    @notice Returns the word id of every token, sentence after sentence
+    @returns array
+    """
+    def get_word_ids(self):
+        return np.array(self.word_buffer, dtype=np.intc)
+
+    """ 
+    @notice Returns the tag id of every token, sentence after sentence, in the order of get_states
+    @returns array
+    """
+    def get_tag_ids(self):
+        return np.array(self.tag_buffer, dtype=np.intc)
+
+    """ 
+    @notice Returns the number of tokens of every sentence
+    @returns array
+    """
+    def get_sentence_lengths(self):
+        return np.diff(np.array(self.offsets, dtype=np.int64))
 
     """ 
     @notice Returns data as a list of lists in original positional indexing
     @returns list
     """
     def get_data(self):
-        return self.data
+        return self.split(self.word_buffer, self.words)
 
     """ 
     @notice Returns states in same positional indexing as original data
     @returns list
     """
     def get_ordered_states(self):
-        return self.ordered_states
+        return self.split(self.tag_buffer, self.tags)
+
+    """ 
+    @notice Convert a buffer of ids back into a list of lists of strings, one list per sentence
+    @param buffer: array of ids
+    @param names: list of the string of each id
+    @returns list
+    """
+    def split(self, buffer, names):
+        offsets = self.offsets
+        return [[names[i] for i in buffer[offsets[s]:offsets[s + 1]]] for s in range(len(offsets) - 1)]
 
     """ 
     @notice Returns states in training data
@@ -146,6 +197,88 @@ class Preprocessor:
         return self.representer
 
 
+""" 
+@notice Process token to generate the word and tag 
+@param line: Tweet Token
+@returns word (string) and state (string)
+"""
+def process_token(line):
+    tokens = line.strip().split()
+    state = tokens[-1]
+    word = " ".join(tokens[0:len(tokens)-1])
+    return word, state
+
+
+""" 
+@notice Read a file with one token per line and an empty line after each sentence, one sentence at a time.
+        Only the current sentence is held in memory.
+@param input_file: Location of input file
+@param labelled: boolean indicating whether each line ends with the tag of the token or not
+@returns generator of (tokens, tags) for each sentence, tags is None if the file is not labelled
+"""
+def read_sentences(input_file, labelled=True):
+    with open(input_file, 'r', encoding="UTF-8") as tweet_list:
+        yield from parse_sentences(tweet_list, labelled)
+
+
+""" 
+@notice Group lines with one token per line and an empty line after each sentence into sentences. Each sentence
+        is yielded as soon as its empty line is read, so lines can come from a stream such as sys.stdin.
+@param lines: iterable of lines
+@param labelled: boolean indicating whether each line ends with the tag of the token or not
+@returns generator of (tokens, tags) for each sentence, tags is None if the lines are not labelled
+"""
+def parse_sentences(lines, labelled=True):
+    tokens = []
+    tags = []
+    for line in lines:
+        if line.strip() == '':
+            if tokens:
+                yield tokens, (tags if labelled else None)
+            tokens = []
+            tags = []
+        elif labelled:
+            word, state = process_token(line)
+            tokens.append(word)
+            tags.append(state)
+        else:
+            tokens.append(line.strip())
+    if tokens:
+        yield tokens, (tags if labelled else None)
+
+
+""" 
+@notice Group sentences into lists of batch_size sentences, the last list may be shorter
+@param sentences: iterable of sentences
+@param batch_size: number of sentences per batch
+@returns generator of lists of sentences
+"""
+def batch_sentences(sentences, batch_size):
+    batch = []
+    for sentence in sentences:
+        batch.append(sentence)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+""" 
+@notice Build the labelled output of a list of sentences, one token and its tag per line and an empty line after each sentence
+@param sentences: list of lists of tokens
+@param paths: list of lists of tags, one for each token
+@returns string
+"""
+def format_labels(sentences, paths):
+    output = []
+    for sentence, path in zip(sentences, paths):
+        for word, tag in zip(sentence, path):
+            output.append(word + " " + tag + "\n")
+        output.append("\n")
+    return "".join(output)
+
+
 #preprocess = Preprocessor('../data/SG/train')
 #representer = preprocess.get_representer()
 #vocabulary = preprocess.get_vocabulary()
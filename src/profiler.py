@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timers and counters for training, labelling and scoring, turned on with main.py --profile.
+
+The stages are timed where they run through the shared PROFILER. It is disabled by default, and then every
+hook returns at once, so the instrumentation costs nothing outside of profiling runs.
+"""
+
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Stages in the order they run, stages not listed here are reported after them
+STAGES = ('read', 'count', 'normalize', 'log_transform', 'load', 'decode', 'write', 'score')
+
+
+class Profiler(object):
+    """Class Profiler.
+
+    The Profiler class adds up the wall time and number of calls of each named stage, and named counters
+    such as the number of tokens decoded. It can also run cProfile during each stage, so the functions
+    taking the time of one stage can be looked at with pstats.
+
+    Worker processes measure into their own copy of the Profiler, and send a snapshot of it back with each
+    result to be merged into the Profiler of the main process. Only their cProfile stats are not collected.
+    The seconds of a stage run by several workers at once are summed over the workers, so they can be more
+    than the wall time, and the report marks these stages.
+
+    Attributes:
+        enabled: boolean indicating whether the stages are measured
+        profile_dir: directory to dump the cProfile stats of every stage to, None to not run cProfile
+        timings: dictionary of stage to [seconds, calls]
+        counters: dictionary of counter to its value
+        samples: dictionary of name to a list of durations in seconds, such as the decoding time of every batch
+        worker_stages: set of the stages whose timings were merged from worker processes
+        profiles: dictionary of stage to its cProfile.Profile
+        active: number of stages currently running, cProfile only follows the outermost one
+    """
+
+    def __init__(self, enabled=False, profile_dir=None):
+        self.enabled = enabled
+        self.profile_dir = profile_dir
+        self.timings = {}
+        self.counters = {}
+        self.samples = {}
+        self.worker_stages = set()
+        self.profiles = {}
+        self.active = 0
+
+    """
+    @notice Start measuring, and clear what was measured before
+    @param profile_dir: directory to dump the cProfile stats of every stage to, None to not run cProfile
+    """
+    def enable(self, profile_dir=None):
+        self.enabled = True
+        self.profile_dir = profile_dir
+        self.reset()
+
+    """
+    @notice Clear the timings, counters, samples and cProfile stats
+    """
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+        self.samples = {}
+        self.worker_stages = set()
+        self.profiles = {}
+
+    """
+    @notice Time the code run in the with block as one call of a stage. A stage running inside another stage is
+            timed too, but its functions are only in the cProfile stats of the outer stage.
+    @param name: name of the stage
+    """
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        profile = None
+        if self.profile_dir is not None and self.active == 0:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        self.active += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.active -= 1
+            if profile is not None:
+                profile.disable()
+            timing = self.timings.setdefault(name, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += 1
+
+    """
+    @notice Add to a counter
+    @param name: name of the counter
+    @param value: number to add
+    """
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    """
+    @notice Record durations, one for each item measured
+    @param name: name of the samples
+    @param seconds: list of durations in seconds
+    """
+    def sample(self, name, seconds):
+        if self.enabled:
+            self.samples.setdefault(name, []).extend(seconds)
+
+    """
+    @notice Get the timings, counters and samples measured so far, without the cProfile stats, to send them
+            from a worker process to the main one
+    @returns dictionary that can be pickled, see merge
+    """
+    def snapshot(self):
+        return {'timings': self.timings, 'counters': self.counters, 'samples': self.samples}
+
+    """
+    @notice Add the timings, counters and samples measured by another Profiler, such as one in a worker process
+    @param snapshot: dictionary returned by snapshot
+    """
+    def merge(self, snapshot):
+        self.worker_stages.update(snapshot['timings'])
+        for name, (seconds, calls) in snapshot['timings'].items():
+            timing = self.timings.setdefault(name, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += calls
+        for name, value in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, seconds in snapshot['samples'].items():
+            self.samples.setdefault(name, []).extend(seconds)
+
+    """
+    @notice Get everything measured so far, with the rates derived from the counters
+    @returns dictionary with the seconds and calls of each stage and whether they are summed over worker processes,
+             the counters, the derived rates and the distribution of each samples in milliseconds
+    """
+    def report(self):
+        names = [name for name in STAGES if name in self.timings]
+        names += [name for name in self.timings if name not in STAGES]
+        stages = {name: {'seconds': self.timings[name][0], 'calls': self.timings[name][1],
+                         'summed_over_workers': name in self.worker_stages} for name in names}
+
+        counters = self.counters
+        derived = {}
+        tokens = counters.get('tokens', 0)
+        sentences = counters.get('sentences', 0)
+        decode_seconds = stages.get('decode', {}).get('seconds', 0)
+        if tokens:
+            derived['unk_rate'] = counters.get('unk_tokens', 0) / tokens
+            derived['states_per_token'] = counters.get('states_explored', 0) / tokens
+            if decode_seconds:
+                derived['decode_tokens_per_sec'] = tokens / decode_seconds
+        if sentences and decode_seconds:
+            derived['decode_ms_per_sentence'] = 1000 * decode_seconds / sentences
+        distributions = {name: distribution(seconds) for name, seconds in self.samples.items() if seconds}
+        return {'stages': stages, 'counters': dict(counters), 'derived': derived, 'distributions': distributions}
+
+    """
+    @notice Print the report as a table of stages followed by the counters and derived rates
+    @param title: printed above the report
+    """
+    def print_report(self, title="Profile"):
+        report = self.report()
+        total = sum(stage['seconds'] for stage in report['stages'].values())
+        print("------------------------ " + title + " --------------------------")
+        print("{:14} {:>10} {:>7} {:>8}".format("stage", "seconds", "calls", "share"))
+        for name, stage in report['stages'].items():
+            share = stage['seconds'] / total if total else 0
+            mark = " *" if stage['summed_over_workers'] else ""
+            print("{:14} {:10.4f} {:7d} {:8.1%}{}".format(name, stage['seconds'], stage['calls'], share, mark))
+        if self.worker_stages:
+            print("* summed over worker processes, can be more than the wall time")
+        for name, value in report['counters'].items():
+            print("{:24} {}".format(name, value))
+        for name, value in report['derived'].items():
+            print("{:24} {:.4f}".format(name, value))
+        for name, ms in report['distributions'].items():
+            print("{:24} {} in ms: min {:.4f} median {:.4f} p90 {:.4f} max {:.4f} mean {:.4f}".format(
+                name, ms['count'], ms['min'], ms['median'], ms['p90'], ms['max'], ms['mean']))
+
+    """
+    @notice Write the cProfile stats of every stage to <path>/<stage>.pstats, to be read with pstats.Stats
+    @param path: directory, created if it does not exist
+    """
+    def dump_stats(self, path):
+        if not self.profiles:
+            return
+        os.makedirs(path, exist_ok=True)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(path, name + '.pstats'))
+
+
+"""
+@notice Summarise durations by their count and their min, median, 90th percentile, max and mean in milliseconds
+@param seconds: non-empty list of durations in seconds
+@returns dictionary
+"""
+def distribution(seconds):
+    ms = sorted(1000 * value for value in seconds)
+    n = len(ms)
+    middle = n // 2
+    median = ms[middle] if n % 2 else (ms[middle - 1] + ms[middle]) / 2
+    return {'count': n, 'min': ms[0], 'median': median, 'p90': ms[min(n - 1, int(0.9 * n))], 'max': ms[-1],
+            'mean': sum(ms) / n}
+
+
+"""
+@notice Write reports to a JSON file
+@param reports: dictionary of name to the report of a Profiler, or to a dictionary of such reports
+@param path: file to write
+"""
+def write_reports(reports, path):
+    with open(path, 'w', encoding='UTF-8') as f:
+        json.dump(reports, f, indent=2)
+
+
+# Shared by every module, disabled unless main.py is run with --profile
+PROFILER = Profiler()
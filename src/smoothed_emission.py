@@ -6,9 +6,11 @@ Created on Sun Dec  2 22:55:50 2018
 """
 
 from good_turing_estimate import SimpleGoodTuring
-from emission import Emission
-from preprocess import Preprocessor
+from emission import Emission, split_tags, label_emission
+from preprocess import Preprocessor, read_sentences
+from pipeline import label_file
 from evaluateResult import evaluate
+import numpy as np
 
 class SmoothedEmission(Emission):
     """Class ImprovedEmission.
@@ -29,19 +31,34 @@ class SmoothedEmission(Emission):
         smoothing_param: Numeric parameter for smoothing (This value is not used in this class and deprecated)
         matrix: array(states, words) of emission probabilities
         word_list: ordered list of words from vocabulary
-        sgt: A dictionary storing the Good-Turing-Smoothed estimation values 
+        sgt_index: dictionary of every word with a Good-Turing estimate, the train words followed by the unseen words,
+                   to its column in sgt
+        in_pool: array(len(sgt_index)) of bool, True for the unseen words given to the constructor
+        sgt: array(states, len(sgt_index) + 1) of Good-Turing-Smoothed estimation values, NaN where a tag has no
+             estimate for a word. The last column is NaN, for words that are not in sgt_index.
     """
     
     def __init__(self, _representer, _vocabulary, _states, unseen_words, _smoothing_param = 1):
         self.representer = _representer
         self.vocabulary = _vocabulary
         self.states = _states
+        self.smoothing_param = _smoothing_param
         self.matrix = []
         self.word_list = list(self.vocabulary.keys())
-        self.sgt = {}
-        
-        for i in self.states:
-            self.sgt[i] = self.instantiate_sgt(i, unseen_words)
+        self.totals = {}
+        self.smoothed_totals = {}
+
+        # The unseen words are shared by all tags, so index them once
+        self.sgt_index = {word: i for i, word in enumerate(self.word_list)}
+        for word in dict.fromkeys(unseen_words):
+            if word not in self.sgt_index:
+                self.sgt_index[word] = len(self.sgt_index)
+        self.in_pool = np.zeros(len(self.sgt_index), dtype=bool)
+        self.in_pool[[self.sgt_index[word] for word in dict.fromkeys(unseen_words)]] = True
+
+        self.sgt = np.full((len(self.states), len(self.sgt_index) + 1), np.nan)
+        for row, state in enumerate(self.states):
+            self.sgt[row, :-1] = self.instantiate_sgt(state, self.in_pool)
         
         
         self.calc_emission_param_matrix()
@@ -55,20 +72,94 @@ class SmoothedEmission(Emission):
     @returns float
     """
     def estimate_emission_param(self, word, state, smooth=True):
-        if word in self.sgt[state]:
-            return self.sgt[state][word]
-        else:
-            return 1/(len(self.vocabulary)**2)
+        return self.estimate_columns([self.sgt_index.get(word, len(self.sgt_index))])[list(self.states).index(state), 0]
+
+
+    """ 
+    @notice Get the Good-Turing estimates of columns of sgt, words a tag has no estimate for get 1/V^2
+    @param columns: list of columns of sgt
+    @returns array(states, columns)
+    """
+    def estimate_columns(self, columns):
+        probs = self.sgt[:, columns]
+        probs[np.isnan(probs)] = 1/(len(self.vocabulary)**2)
+        return probs
+    
+    
+    """
+    @notice Calculates the entire emission param matrix for all words and states from the Good-Turing estimates,
+            gathering the column of every word from sgt
+    @param smooth: boolean indicating whether to add the #UNK# column or not
+    """
+    def calc_emission_param_matrix(self, smooth=True):
+        print("Building emission parameter matrix...")
+        if smooth:
+            self.word_list.append('#UNK#')
+            self.vocabulary['#UNK#'] = len(self.states)
+            for state in self.states:
+                self.representer[state]['#UNK#'] = 1
+        self.word_index = {word: i for i, word in reversed(list(enumerate(self.word_list)))}
+        self.calc_totals()
+        self.matrix = self.estimate_columns([self.sgt_index.get(word, len(self.sgt_index)) for word in self.word_list])
+        print("Calculated emission parameter matrix with {} states (rows) and {} words (columns).".format(self.matrix.shape[0], self.matrix.shape[1]))
+    
+    
+    """ 
+    @notice Add new labelled sentences to the counts without recounting the train data. The Good-Turing estimates
+            of a tag depend on all of its counts, so the rows of sgt of the tags in the sentences are estimated
+            again, and the other rows are kept. New words get new columns in sgt, outside of the unseen word pool.
+            The matrix is gathered from sgt again, since the probability of words without an estimate depends on
+            the vocabulary size. Build a new CompiledHMM after updating.
+    @param sentences: iterable of (tokens, tags), as given by read_sentences
+    @returns None
+    """
+    def update(self, sentences):
+        sentences = list(sentences)
+        for tokens, tags in sentences:
+            for state in tags:
+                if state not in self.representer:
+                    raise ValueError("Tag {} never occurred in train data, retrain to add new tags.".format(state))
+
+        touched = set()
+        for tokens, tags in sentences:
+            for word, state in zip(tokens, tags):
+                if word not in self.vocabulary:
+                    self.vocabulary[word] = 0
+                    self.word_list.append(word)
+                    self.word_index.setdefault(word, len(self.word_list) - 1)
+                if word not in self.sgt_index:
+                    self.sgt_index[word] = len(self.sgt_index)
+                self.vocabulary[word] += 1
+                words_dict = self.representer[state]
+                words_dict[word] = words_dict.get(word, 0) + 1
+                self.totals[state] += 1
+                self.smoothed_totals[state] += 1
+                touched.add(state)
+
+        # New words are not in the pool, and the last column stays NaN for words without an estimate
+        n_new = len(self.sgt_index) - len(self.in_pool)
+        if n_new:
+            self.in_pool = np.concatenate([self.in_pool, np.zeros(n_new, dtype=bool)])
+            sgt = np.full((len(self.states), len(self.sgt_index) + 1), np.nan)
+            sgt[:, :self.sgt.shape[1] - 1] = self.sgt[:, :-1]
+            self.sgt = sgt
+
+        for row, state in enumerate(self.states):
+            if state in touched:
+                self.sgt[row, :-1] = self.instantiate_sgt(state, self.in_pool)
+
+        self.matrix = self.estimate_columns([self.sgt_index.get(word, len(self.sgt_index)) for word in self.word_list])
     
     
     """ 
     @notice Instantiate Simple Good Turing Estimates for all the vocabulary as well as unseen words
     @param state: tag 
-    @param unseen_words: list of words not occuring in the representer of the particular state 
-    @returns Dictionary
+    @param in_pool: array(len(sgt_index)) of bool, True for the words to estimate unseen probabilities for
+    @returns array(len(sgt_index)) of estimates, NaN for words without an estimate
     """
-    def instantiate_sgt(self, state, unseen_words):
-        state_vocab = self.representer[state]
+    def instantiate_sgt(self, state, in_pool):
+        # #UNK# is only counted once the matrix is built, it gets no estimate of its own
+        state_vocab = {word: count for word, count in self.representer[state].items() if word != '#UNK#'}
         s = SimpleGoodTuring(state_vocab, max(state_vocab.values()))
         r, n = s.count_of_counts(state_vocab, max(state_vocab.values()))
         Z_arr = s.Z_smoothing(r, n)
@@ -76,8 +167,22 @@ class SmoothedEmission(Emission):
         S =  s.compute_S(a, b, r)
         r_star = s.smooth_counts(r, n, S)
         P0, sgt_probs= s.sgt_discount(r, r_star, n)
-        spec_prob = s.species_probs(state_vocab, r, P0, sgt_probs, unseen_words)
-        return spec_prob
+
+        seen = np.zeros(len(in_pool), dtype=bool)
+        columns = [self.sgt_index[word] for word in state_vocab]
+        seen[columns] = True
+
+        # Words seen with the tag, or in the pool, that are not both share the probability of unseen words
+        # and words both seen and in the pool get the probability of their count
+        probs = np.full(len(in_pool), np.nan)
+        unseen = seen ^ in_pool
+        if unseen.any():
+            probs[unseen] = P0 / np.count_nonzero(unseen)
+        counts = np.fromiter(state_vocab.values(), dtype=int, count=len(state_vocab))
+        seen_probs = s.count_probs(counts, r, sgt_probs)
+        both = in_pool[columns]
+        probs[np.array(columns)[both]] = seen_probs[both]
+        return probs
     
     
     """ 
@@ -85,52 +190,52 @@ class SmoothedEmission(Emission):
     @param state: Dictionary 
     """
     def getSmoothDict(self, state):
-        return self.sgt[state]
+        row = self.sgt[list(self.states).index(state)]
+        return {word: row[i] for word, i in self.sgt_index.items() if not np.isnan(row[i])}
     
     
     """ 
-    @notice Given the input file, label the word sequence using the tag that returns the maximum emission probability
+    @notice Get the emission probabilities of a list of tokens, including dev tokens that are not in the emission matrix
+    @param tokens: list of tokens
+    @returns array(states, tokens)
+    """
+    def token_probs(self, tokens):
+        missing = len(self.sgt_index)
+        return self.estimate_columns([self.sgt_index.get(word, missing) for word in tokens])
+    
+    
+    """ 
+    @notice Given the input file, label the word sequence using the tag that returns the maximum emission probability.
+            Without a model, dev words that are not in the train data get their own Good-Turing estimates. A
+            CompiledHMM only has the columns of the emission matrix, so with one they are labelled as #UNK#,
+            and ties go to the first tag as in Emission.labelSequence.
     @param _inputFile: Location of input file
     @param _outputFile: Name of output file to be created
+    @param model: CompiledHMM built from this SmoothedEmission, None to label with the Good-Turing estimates
+    @param batch_size: number of sentences labelled at once
+    @param workers: number of processes labelling batches in parallel
     @returns None
     """
-    def labelSequence(self, _inputFile, _outputFile):
-        tags = self.states
+    def labelSequence(self, _inputFile, _outputFile, model=None, batch_size=1000, workers=1):
+        if model is not None:
+            label_emission(_inputFile, _outputFile, model, batch_size, workers)
+            return
+
+        tags = list(self.states)
+
+        def decode(batch):
+            probs = self.token_probs([word for sentence in batch for word in sentence])
+            # Ties go to the last tag, the same as comparing the tags in order with >=
+            best_tags = len(tags) - 1 - np.argmax(probs[::-1], axis=0)
+            return split_tags(batch, [tags[i] for i in best_tags])
         
         try:
-            tweet_list = open(_inputFile, 'r',  encoding="UTF-8")
-            output_file= open(_outputFile,"w+", encoding="UTF-8")
-            lines = tweet_list.readlines()
-            
-            length = 0
-            for token in lines:
-                if token == "\n":
-                    output_file.write("\n")
-                    continue
-                else:
-                    length = length+1
-                    emission_prob = 0
-                    best_tag = None
-                    for tag in tags:
-                        prob = self.estimate_emission_param(token.strip(), tag, True)
-                        #print(prob)
-                        if prob >= emission_prob:
-                            emission_prob = prob
-                            best_tag = tag
-                            
-                    #print(best_tag)
-                    labelled_token = " ".join([token.strip(), best_tag])
-                    output_file.write(labelled_token)
-                    
-                    if (length != len(lines)):
-                        output_file.write("\n")
+            label_file(_inputFile, _outputFile, decode, batch_size, workers=workers)
 
         except IOError:
             print(IOError)
 
         finally:
-            tweet_list.close()
-            output_file.close()
             print("Sequence Labelling for", _inputFile, "completed. Results are saved in", _outputFile)
 
 
@@ -171,21 +276,13 @@ def getAllTokens(_inputFile):
     allTokens = []
     
     try:
-        tweet_list = open(_inputFile, 'r',  encoding="UTF-8")
-        lines = tweet_list.readlines()
-    
-        for token in lines:
-            if token == "\n":
-                continue
-            else:
-                word = token.strip()
-                allTokens.append(word)
+        for tokens, tags in read_sentences(_inputFile, labelled=False):
+            allTokens.extend(tokens)
             
     except IOError:
         print(IOError)
     
     finally:
-        tweet_list.close()
         return allTokens
 
 # Define variables
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Array-backed column-compressed storage for emission matrices with large vocabularies.
+"""
+
+import numpy as np
+
+
+class SparseColumns(object):
+    """Class SparseColumns.
+
+    The SparseColumns class stores a (rows, columns) matrix in compressed sparse column (CSC) form. Only the
+    stored values of each column are kept, every other entry takes the default value of its row. Columns are
+    fetched one at a time or for a list of columns, without building the dense matrix, so it can stand in for
+    a dense emission matrix in the decoders through matrix[:, column] and matrix[:, columns].
+
+    Attributes:
+        shape: (rows, columns)
+        data: array of stored values, grouped by column
+        indices: array of the row of each stored value
+        indptr: array(columns + 1), the stored values of column j are data[indptr[j]:indptr[j + 1]]
+        default: array(rows) of the value of entries that are not stored
+    """
+
+    def __init__(self, data, indices, indptr, default, shape):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.default = default
+        self.shape = shape
+
+    """
+    @notice Build from (row, column, value) entries, each (row, column) pair given at most once
+    @param rows: row of each entry
+    @param columns: column of each entry
+    @param values: value of each entry
+    @param default: value of the entries that are not given, one per row
+    @param shape: (rows, columns)
+    @returns SparseColumns
+    """
+    @classmethod
+    def from_entries(cls, rows, columns, values, default, shape):
+        rows = np.asarray(rows, dtype=np.int32)
+        columns = np.asarray(columns, dtype=np.int64)
+        order = np.argsort(columns, kind='stable')
+        indptr = np.zeros(shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(columns, minlength=shape[1]), out=indptr[1:])
+        return cls(np.asarray(values, dtype=float)[order], rows[order], indptr, np.asarray(default, dtype=float), tuple(shape))
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.indices.nbytes + self.indptr.nbytes + self.default.nbytes
+
+    """
+    @notice Get one column as a dense array
+    @param column: int
+    @returns array(rows)
+    """
+    def column(self, column):
+        out = self.default.copy()
+        start, stop = self.indptr[column], self.indptr[column + 1]
+        out[self.indices[start:stop]] = self.data[start:stop]
+        return out
+
+    """
+    @notice Get several columns as a dense array, in the given order
+    @param columns: sequence of int
+    @returns array(rows, len(columns))
+    """
+    def columns(self, columns):
+        columns = np.asarray(columns, dtype=np.int64)
+        out = np.repeat(self.default[:, np.newaxis], len(columns), axis=1)
+        starts = self.indptr[columns]
+        counts = self.indptr[columns + 1] - starts
+        # Position in data of every stored value of the requested columns
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(starts, counts) + offsets
+        out[self.indices[positions], np.repeat(np.arange(len(columns)), counts)] = self.data[positions]
+        return out
+
+    def __getitem__(self, key):
+        if not (isinstance(key, tuple) and len(key) == 2 and isinstance(key[0], slice) and key[0] == slice(None)):
+            raise IndexError("SparseColumns only supports matrix[:, column] and matrix[:, columns].")
+        if np.ndim(key[1]) == 0:
+            return self.column(int(key[1]))
+        return self.columns(key[1])
+
+    """
+    @notice Apply an elementwise function to the stored values and the defaults, keeping the same structure
+    @param function: function of an array
+    @returns SparseColumns
+    """
+    def map(self, function):
+        return SparseColumns(function(self.data), self.indices, self.indptr, function(self.default), self.shape)
+
+    """
+    @notice Convert the data and defaults to another dtype
+    @param dtype: numpy dtype
+    @returns SparseColumns
+    """
+    def astype(self, dtype):
+        return self.map(lambda array: array.astype(dtype))
+
+    def toarray(self):
+        return self.columns(np.arange(self.shape[1]))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming tagger. Loads a saved or cached model once, then tags tweets read from stdin and writes them to stdout.
+
+Input is one token per line with an empty line after each tweet, as in dev.in. Each tagged tweet is written
+as soon as it is decoded, one token and its tag per line with an empty line after each tweet, as in dev.out.
+Messages from loading or training the model go to stderr.
+
+Usage (from src/):
+    python tag.py --model-dir ../models/EN/p4 < ../data/EN/dev.in > dev.p4.out
+    cat tweets | python tag.py --train ../data/EN/train --order 2 --cache-dir ../cache
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+from compiled_hmm import CompiledHMM
+from model_cache import ModelCache
+from preprocess import parse_sentences, batch_sentences, format_labels
+import emission
+import viterbi
+import viterbiOrder2
+
+
+"""
+@notice Load the model from --model-dir, or get it from the cache, which only trains it if the training file
+        has not been trained on before. Messages are written to stderr, stdout only carries tagged tweets.
+@param args: parsed arguments
+@returns CompiledHMM
+"""
+def load_model(args):
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.model_dir is not None:
+            return CompiledHMM.load(args.model_dir)
+        cache = ModelCache(args.cache_dir, args.cache_size * 1024 ** 2, args.sparse, args.bio)
+        return cache.compiled_model(args.train, args.order)
+
+
+"""
+@notice Get the decode function of a model, by its order
+@param model: CompiledHMM
+@param beam: number of states kept at each word by the Viterbi models, None to keep all
+@param threshold: log10 margin below the best state beyond which the Viterbi models drop states, None to keep all
+@returns function taking a list of sentences and returning a list of paths
+"""
+def decoder(model, beam=None, threshold=None):
+    if model.order == 0:
+        return lambda batch: emission.decode_batch(model, batch)
+    if model.order == 1:
+        return lambda batch: viterbi.decode_batch(model, batch, beam, threshold)
+    return lambda batch: viterbiOrder2.decode_batch(model, batch, beam, threshold)
+
+
+"""
+@notice Tag the tweets of an input stream and write them to an output stream as they are decoded
+@param model: CompiledHMM
+@param input_stream: iterable of lines, such as sys.stdin
+@param output_stream: open file to write to, such as sys.stdout
+@param batch_size: number of tweets decoded at once, a batch is only decoded once all of its tweets are read
+@param flush_every: number of tweets written between flushes of output_stream, 0 to only flush at the end
+@param beam: number of states kept at each word by the Viterbi models, None to keep all
+@param threshold: log10 margin below the best state beyond which the Viterbi models drop states, None to keep all
+@returns (int, int) number of tweets and tokens tagged
+"""
+def tag_stream(model, input_stream, output_stream, batch_size=1, flush_every=1, beam=None, threshold=None):
+    decode = decoder(model, beam, threshold)
+    sentences = (tokens for tokens, tags in parse_sentences(input_stream, labelled=False))
+    n_sentences = 0
+    n_tokens = 0
+    unflushed = 0
+    for batch in batch_sentences(sentences, batch_size):
+        output_stream.write(format_labels(batch, decode(batch)))
+        n_sentences += len(batch)
+        n_tokens += sum(len(sentence) for sentence in batch)
+        unflushed += len(batch)
+        if flush_every and unflushed >= flush_every:
+            output_stream.flush()
+            unflushed = 0
+    output_stream.flush()
+    return n_sentences, n_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tag tweets read from stdin and write them to stdout.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--model-dir", help="Directory of a saved model, see main.py --model-dir.")
+    source.add_argument("--train", help="Training file, the model is trained once and kept in the cache.")
+    parser.add_argument("--order", type=int, default=2, choices=[0, 1, 2],
+                        help="With --train: 0 for the emission model, 1 for viterbi and 2 for viterbi2.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="With --train: directory caching trained models across runs.")
+    parser.add_argument("--cache-size", type=int, default=256, help="Maximum size of the cache directory in MB.")
+    parser.add_argument("--sparse", action="store_true", help="With --train: store the emission matrix sparsely.")
+    parser.add_argument("--bio", action="store_true", help="With --train: penalise unseen transitions breaking BIO constraints.")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of tweets decoded at once. 1 writes every tweet as soon as it is read.")
+    parser.add_argument("--flush-every", type=int, default=1,
+                        help="Number of tweets written between flushes of stdout, 0 to only flush at the end.")
+    parser.add_argument("--beam", type=int, default=None,
+                        help="Viterbi models only keep this many states (pairs of states for order 2) at each word.")
+    parser.add_argument("--beam-threshold", type=float, default=None,
+                        help="Viterbi models drop states whose log10 probability is more than this below the best one.")
+    args = parser.parse_args()
+
+    if args.batch_size < 1:
+        raise ValueError('Batch size must be at least 1.')
+
+    model = load_model(args)
+    print("Tagging with an order {} model of {} tags and {} words.".format(
+        model.order, len(model.states), len(model.word_list)), file=sys.stderr)
+
+    start = time.perf_counter()
+    try:
+        n_sentences, n_tokens = tag_stream(model, sys.stdin, sys.stdout, args.batch_size, args.flush_every,
+                                           args.beam, args.beam_threshold)
+    except BrokenPipeError:
+        # The reader of stdout went away, e.g. piped into head. Send the unwritten output nowhere and stop.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+    seconds = time.perf_counter() - start
+    print("Tagged {} tweets ({} tokens) in {:.3f}s.".format(n_sentences, n_tokens, seconds), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
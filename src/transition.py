@@ -1,81 +1,126 @@
 from preprocess import Preprocessor
-import pandas as pd
+from profiler import PROFILER
+import numpy as np
+
+
+# Encodes the tags of labelled sentences as indices into states
+# sentences is an iterable of (tokens, tags), as given by read_sentences
+# returns the tags of all sentences as one flat array, and the length of each sentence
+def encode_sentences(sentences, state_index):
+    tags = []
+    lengths = []
+    for tokens, sentence_tags in sentences:
+        for tag in sentence_tags:
+            if tag not in state_index:
+                raise ValueError("Tag {} never occurred in train data, retrain to add new tags.".format(tag))
+            tags.append(state_index[tag])
+        lengths.append(len(sentence_tags))
+    return np.array(tags, dtype=int), np.array(lengths, dtype=int)
+
+
+# BIO constraints between tags, an I-X tag continues an entity, so it can only follow B-X or I-X
+# returns whether each state u can be followed by each state v
+def bio_transitions(states):
+    n = len(states)
+    allowed = np.ones((n, n), dtype=bool)
+    for v, state in enumerate(states):
+        if state.startswith('I-'):
+            allowed[:, v] = [prev[:2] in ('B-', 'I-') and prev[2:] == state[2:] for prev in states]
+    return allowed
 
 
 class Transition(object):
     def __init__(self):
-        self.start = {}  # probabilities of each states being a start word
-        self.stop = {}  # probabilities of each states being a stop word
-        self.matrix = {}  # probabilities of each states leading into the next states
+        self.start = np.zeros(0)  # probabilities of each states being a start word
+        self.stop = np.zeros(0)  # probabilities of each states being a stop word
+        self.matrix = np.zeros((0, 0))  # probabilities of each states leading into the next states
         self.states = []  # list of states
+        self.state_index = {}  # index of each state in start, stop and the rows and columns of matrix
+        self.start_count = np.zeros(0, dtype=int)  # number of sentences starting with each state
+        self.stop_count = np.zeros(0, dtype=int)  # number of sentences ending with each state
+        self.transition_count = np.zeros((0, 0), dtype=int)  # number of times each state leads into the next states
 
     # Computes transition matrix and probabilities of start and stop words
     def compute_params(self, preprocessor):
         print("Building transition parameters...")
-        # Setting up start/stop counters
-        self.states = preprocessor.get_states()
-        start_count = {}
-        stop_count = {}
-        for state in self.states:
-            start_count[state] = 0
-            stop_count[state] = 0
-
-        # Setting up empty transition matrix, read as "Transition from row label to column label"
-        transition_count = pd.DataFrame(0, index=self.states, columns=self.states)
-
-        # Bringing in ordered tweet labels from dataset
-        tweet_labels = preprocessor.get_ordered_states()
-
-        for tweet in tweet_labels:
-            # Counts start and stop words
-            start_count[tweet[0]] += 1
-            stop_count[tweet[len(tweet)-1]] += 1
-
-            # Counting transitions from state x to state y
-            for tag_index in range(len(tweet)):
-                if tag_index == len(tweet) - 1:  # if reached last state of tweet
-                    continue
-                transition_count.at[tweet[tag_index], tweet[tag_index+1]] += 1
+        self.states = list(preprocessor.get_states())
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        n = len(self.states)
+
+        # Bringing in ordered tweet labels from dataset as tag ids, which are indices into self.states
+        tags = preprocessor.get_tag_ids().astype(int)
+        lengths = preprocessor.get_sentence_lengths()
+        with PROFILER.stage('count'):
+            self.start_count, self.stop_count, self.transition_count = self.count(tags, lengths)
 
         # Normalises values across rows ino probabilities, assigns to self.matrix
-        transition_count["sum"] = transition_count.sum(axis=1)
-        self.matrix = transition_count.loc[:, transition_count.columns.values[0]:transition_count.columns.values[-2]].div(transition_count["sum"], axis=0)
+        with PROFILER.stage('normalize'):
+            self.matrix = np.zeros((n, n))
+            self.normalise(np.arange(n))
         print("Calculated transition parameter matrix with {} rows and columns.".format(self.matrix.shape[0]))
 
+    # Adds the transitions of new labelled sentences, given as (tokens, tags), without recounting the train data
+    # only the rows of the matrix with new transitions are normalised again
+    def update(self, sentences):
+        tags, lengths = encode_sentences(sentences, self.state_index)
+        start_count, stop_count, transition_count = self.count(tags, lengths)
+        self.start_count += start_count
+        self.stop_count += stop_count
+        self.transition_count += transition_count
+        self.normalise(np.flatnonzero(transition_count.sum(axis=1)))
+
+    # Counts start words, stop words and transitions of tags, the tags of every tweet one after the other
+    def count(self, tags, lengths):
+        n = len(self.states)
+        lengths = lengths[lengths > 0]
+        starts = np.cumsum(lengths) - lengths
+        tweet_ids = np.repeat(np.arange(len(lengths)), lengths)
+
+        # Counts start and stop words
+        start_count = np.bincount(tags[starts], minlength=n)
+        stop_count = np.bincount(tags[starts + lengths - 1], minlength=n)
+
+        # Counting transitions from state x to state y, read as "Transition from row label to column label"
+        same_tweet = tweet_ids[:-1] == tweet_ids[1:]
+        transition_count = np.bincount(tags[:-1][same_tweet] * n + tags[1:][same_tweet], minlength=n * n).reshape(n, n)
+        return start_count, stop_count, transition_count
+
+    # Normalises the counts of the given rows into probabilities, and the probabilities of start and stop states
+    def normalise(self, rows):
+        counts = self.transition_count[rows]
+        with np.errstate(invalid='ignore'):
+            self.matrix[rows] = counts / counts.sum(axis=1)[:, np.newaxis]
+
         # Calculates probabilities of start and stop states
-        self.start = self.edge_state_compute(start_count)
-        self.stop = self.edge_state_compute(stop_count)
+        self.start = self.edge_state_compute(self.start_count)
+        self.stop = self.edge_state_compute(self.stop_count)
+
+    def edge_state_compute(self, edge_counts):
+        return edge_counts / edge_counts.sum()
 
-    def edge_state_compute(self, edge_words):
-        total = sum(edge_words.values())
-        for key in edge_words.keys():
-            edge_words[key] = edge_words[key]/total
-        return edge_words
+    # Transitions seen in the train data
+    # returns array(states, states) of bool, every other transition has probability 0
+    def allowed_transitions(self):
+        return self.transition_count > 0
 
     # Probability that sentence starts with given state
     def startwith(self, state):
-        if state in self.start:
-            return self.start[state]
+        if state in self.state_index:
+            return self.start[self.state_index[state]]
         else:
             return 0
 
     # Probability that sentence ends with given state
     def stopwith(self, state):
-        if state in self.stop:
-            return self.stop[state]
+        if state in self.state_index:
+            return self.stop[self.state_index[state]]
         else:
             return 0
 
     # Probability that state0 is followed by state1
     def transit_prob(self, state0, state1):
-        if state0 in self.matrix:
-            if state1 in self.matrix[state0]:
-                if state0 in self.states:
-                    return self.matrix.at[state0, state1]
-                else:
-                    raise RuntimeError("current tag:" + state0 + "\n never occurred in train data")
-            else:
-                return 0
+        if state0 in self.state_index and state1 in self.state_index:
+            return self.matrix[self.state_index[state0], self.state_index[state1]]
         else:
             return 0
 
@@ -86,8 +131,9 @@ class Transition(object):
         return self.stop
 
     def get_transition_matrix(self):
-        return self.matrix.values
-
-
-
+        return self.matrix
 
+    # Transition matrix as a pandas DataFrame labelled with the states, pandas is only needed for this export
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.matrix, index=self.states, columns=self.states)
@@ -1,15 +1,24 @@
 from preprocess import Preprocessor
-import pandas as pd
+from transition import encode_sentences
+from profiler import PROFILER
 import numpy as np
 
+# Probability given to (u,v) -> w transitions never seen in the train data
+SMOOTHING = 0.000000000000000001
+
 class Transition2(object):
     def __init__(self):
-        self.start = {}  # probabilities of each states being a start word
-        self.stop = {}  # probabilities of each states being a stop word
-        self.start_u_matrix = {} # probabilities of (START,u)->v
-        self.matrix = {}  # probabilities of each states leading into the next states
+        self.start = np.zeros(0)  # probabilities of each states being a start word
+        self.stop = np.zeros(0)  # probabilities of each tuple of states being the last two words
+        self.start_u_matrix = np.zeros((0, 0)) # probabilities of (START,u)->v
+        self.matrix = np.zeros((0, 0))  # probabilities of each tuple of states leading into the next states
         self.states = []  # list of states
         self.states_order2 = [] # list of tuples of states
+        self.state_index = {}  # index of each state in start and the columns of the matrices
+        self.start_start_count = np.zeros(0, dtype=int)  # number of sentences starting with each state
+        self.start_u_count = np.zeros((0, 0), dtype=int)  # number of sentences starting with each (u,v)
+        self.transition_count = np.zeros((0, 0), dtype=int)  # number of times each (u,v) leads into the next states
+        self.stop_count = np.zeros(0, dtype=int)  # number of sentences ending with each (u,v)
 
     # Computes transition matrix and probabilities of start and stop words
     # start_start is a vector of size = state*1 
@@ -18,75 +27,93 @@ class Transition2(object):
     # stop is a vector of size state^2*1
     def compute_params(self, preprocessor):
         print("Building transition parameters...")
-        # Setting up start/stop counters
-        self.states = preprocessor.get_states()
-        start_start_count = {}
-        stop_count = {}
+        self.states = list(preprocessor.get_states())
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        n = len(self.states)
+        # set up rows of tuples for different permutation of states
         for state in self.states:
-            start_start_count[state] = 0  #first word
-            # set up rows of tuples for different permutation of states
             for state2 in self.states:
                 self.states_order2.append((state,state2))
-                stop_count[(state,state2)] = 0  #last word
-        
-        # first transition (start,u) -> v
-        start_u_count = pd.DataFrame(0, index=self.states, columns=self.states)
-        
-        # Setting up empty transition matrix, read as "Transition from row label to column label"
-        transition_count = pd.DataFrame(0, index=self.states_order2, columns=self.states)
 
-        # Bringing in ordered tweet labels from dataset
-        tweet_labels = preprocessor.get_ordered_states()
+        # Bringing in ordered tweet labels from dataset as tag ids, which are indices into self.states
+        tags = preprocessor.get_tag_ids().astype(int)
+        lengths = preprocessor.get_sentence_lengths()
+        with PROFILER.stage('count'):
+            self.start_start_count, self.start_u_count, self.transition_count, self.stop_count = self.count(tags, lengths)
 
-        for tweet in tweet_labels:
-            # Counts start words
-            start_start_count[tweet[0]] += 1
-            
-            # Count transition from first to second state (START,u) -> v
-            if(len(tweet)>1):
-                start_u_count.at[tweet[0], tweet[1]] += 1
-            # Counting transitions from state (u,v) -> w
-            for tag_index in range(1,len(tweet)-1):
-                transition_count.at[(tweet[tag_index-1],tweet[tag_index]), tweet[tag_index+1]] += 1
-            
-            # Counts stop words
-            if(len(tweet)>1):
-                stop_count[(tweet[len(tweet)-2],tweet[len(tweet)-1])] += 1
-
-        # print(stop_count)
-        # print(start_u_count)
-        # print(transition_count)
         # Normalises values across rows into probabilities, assigns to self.matrix
-        start_u_count["sum"] = start_u_count.sum(axis=1)
-        self.start_u_matrix = start_u_count.loc[:, start_u_count.columns.values[0]:start_u_count.columns.values[-2]].div(start_u_count["sum"], axis=0)
-        transition_count["sum"] = transition_count.sum(axis=1)
-        self.matrix = transition_count.loc[:, transition_count.columns.values[0]:transition_count.columns.values[-2]].div(transition_count["sum"], axis=0)
-        # convert nan to 0
-        where_are_NaNs = np.isnan(self.start_u_matrix)
-        self.start_u_matrix[where_are_NaNs] = 0
-        where_are_NaNs = np.isnan(self.matrix)
-        self.matrix[where_are_NaNs] = 0
-        self.matrix[self.matrix==0] = 0.000000000000000001  # replace 0 with a small value
+        with PROFILER.stage('normalize'):
+            self.start_u_matrix = np.zeros((n, n))
+            self.matrix = np.zeros((n * n, n))
+            self.normalise(np.arange(n), np.arange(n * n))
         
         print("Calculated transition parameter matrix with {} rows and columns.".format(self.matrix.shape[0]))
 
+    # Adds the transitions of new labelled sentences, given as (tokens, tags), without recounting the train data
+    # only the rows of start_u_matrix and matrix with new transitions are normalised again
+    def update(self, sentences):
+        tags, lengths = encode_sentences(sentences, self.state_index)
+        start_start_count, start_u_count, transition_count, stop_count = self.count(tags, lengths)
+        self.start_start_count += start_start_count
+        self.start_u_count += start_u_count
+        self.transition_count += transition_count
+        self.stop_count += stop_count
+        self.normalise(np.flatnonzero(start_u_count.sum(axis=1)), np.flatnonzero(transition_count.sum(axis=1)))
+
+    # Counts start words, (START,u) -> v transitions, (u,v) -> w transitions and stop words of tags,
+    # the tags of every tweet one after the other
+    def count(self, tags, lengths):
+        n = len(self.states)
+        lengths = lengths[lengths > 0]
+        starts = np.cumsum(lengths) - lengths
+        ends = starts + lengths - 1
+        tweet_ids = np.repeat(np.arange(len(lengths)), lengths)
+        long_tweets = lengths > 1
+
+        # Counts start words
+        start_start_count = np.bincount(tags[starts], minlength=n)
+
+        # Count transition from first to second state (START,u) -> v
+        start_u_count = np.bincount(tags[starts[long_tweets]] * n + tags[starts[long_tweets] + 1], minlength=n * n).reshape(n, n)
+
+        # Counting transitions from state (u,v) -> w, read as "Transition from row label to column label"
+        same_tweet = tweet_ids[:-2] == tweet_ids[2:]
+        trigrams = (tags[:-2][same_tweet] * n + tags[1:-1][same_tweet]) * n + tags[2:][same_tweet]
+        transition_count = np.bincount(trigrams, minlength=n * n * n).reshape(n * n, n)
+
+        # Counts stop words
+        stop_count = np.bincount(tags[ends[long_tweets] - 1] * n + tags[ends[long_tweets]], minlength=n * n)
+        return start_start_count, start_u_count, transition_count, stop_count
+
+    # Normalises the counts of the given rows of start_u_matrix and matrix into probabilities,
+    # and the probabilities of start and stop states
+    def normalise(self, start_u_rows, rows):
+        start_u_counts = self.start_u_count[start_u_rows]
+        counts = self.transition_count[rows]
+        # convert nan to 0
+        with np.errstate(invalid='ignore'):
+            self.start_u_matrix[start_u_rows] = np.nan_to_num(start_u_counts / start_u_counts.sum(axis=1)[:, np.newaxis], nan=0)
+            matrix = np.nan_to_num(counts / counts.sum(axis=1)[:, np.newaxis], nan=0)
+        matrix[matrix==0] = SMOOTHING  # replace 0 with a small value
+        self.matrix[rows] = matrix
+
         # Calculates probabilities of start and stop states
-        self.start = self.edge_state_compute(start_start_count)
-        self.stop = self.edge_state_compute(stop_count)
-        # print(self.start_u_matrix)
-        # print(self.matrix)
-        # print(self.stop)
-
-    def edge_state_compute(self, edge_words):
-        total = sum(edge_words.values())
-        for key in edge_words.keys():
-            edge_words[key] = edge_words[key]/total
-        return edge_words
+        self.start = self.edge_state_compute(self.start_start_count)
+        self.stop = self.edge_state_compute(self.stop_count)
+
+    def edge_state_compute(self, edge_counts):
+        return edge_counts / edge_counts.sum()
+
+    # (u,v) -> w transitions seen in the train data
+    # returns array(states^2, states) of bool in the layout of matrix, other transitions have probability SMOOTHING,
+    # times BIO_PENALTY when they break BIO constraints in a model compiled with bio, see CompiledHMM
+    def allowed_transitions(self):
+        return self.transition_count > 0
 
     # Probability that sentence starts with given state
     def startwith(self, state):
-        if state in self.start:
-            return self.start[state]
+        if state in self.state_index:
+            return self.start[self.state_index[state]]
         else:
             return 0
 
@@ -94,8 +121,8 @@ class Transition2(object):
     def stopwith(self, prev):
         state0 = prev[0]
         state1 = prev[1]
-        if (state0,state1) in self.stop:
-            return self.stop[(state0,state1)]
+        if state0 in self.state_index and state1 in self.state_index:
+            return self.stop[self.state_index[state0] * len(self.states) + self.state_index[state1]]
         else:
             return 0
 
@@ -104,23 +131,15 @@ class Transition2(object):
     def transit_prob(self, prev, state2):
         state0 = prev[0]
         state1 = prev[1]
-        if state0 in self.states and state1 in self.states and state2 in self.states:
-            # print("states : ",prev," -> ",state2)
-            # print("prob = ",self.matrix.at[(state0, state1), state2])
-            return self.matrix.at[(state0, state1), state2]
+        if state0 in self.state_index and state1 in self.state_index and state2 in self.state_index:
+            return self.matrix[self.state_index[state0] * len(self.states) + self.state_index[state1], self.state_index[state2]]
         else:
             raise RuntimeError("current tag:",(state0,state1), "\n never occurred in train data")
             
     # Probability that state0 is followed by state1 for (START,state0) -> state1 
     def start_u_transit_prob(self, state0, state1):
-        if state0 in self.start_u_matrix:
-            if state1 in self.start_u_matrix[state0]:
-                if state0 in self.states:
-                    return self.start_u_matrix.at[state0, state1]
-                else:
-                    raise RuntimeError("current tag:" + state0 + "\n never occurred in train data")
-            else:
-                return 0
+        if state0 in self.state_index and state1 in self.state_index:
+            return self.start_u_matrix[self.state_index[state0], self.state_index[state1]]
         else:
             return 0
 
@@ -131,11 +150,12 @@ class Transition2(object):
         return self.stop
 
     def get_transition_matrix(self):
-        return self.matrix.values
+        return self.matrix
     
     def get_start_u_matrix(self):
-        return self.start_u_matrix.values
-
-
-
+        return self.start_u_matrix
 
+    # Transition matrix as a pandas DataFrame with (state0, state1) rows, pandas is only needed for this export
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.matrix, index=pd.MultiIndex.from_tuples(self.states_order2), columns=self.states)
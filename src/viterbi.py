@@ -1,51 +1,48 @@
 from transition import Transition
 from emission import Emission
+from compiled_hmm import CompiledHMM
+from pipeline import label_file
+from profiler import PROFILER
+from emission import count_decoded
 import numpy as np
+import time
 
+# Largest share of allowed transitions for which the decoders only score the allowed ones, for each order, see
+# use_predecessors. From `python benchmark.py predecessors all`, scoring only the allowed transitions is as fast as
+# the dense broadcast at about 0.7 of them for order 1, and at 0.15 (FR) to 0.3 (EN, SG) for order 2, which also
+# scores the smoothed floor of the unseen ones.
+PREDECESSOR_DENSITY = {1: 0.7, 2: 0.15}
 
-def best_path(transition, emission, sentence):
+
+def best_path(transition, emission, sentence, model=None):
     """
     Find the likeliest path in a resulting in given sentence.
 
     :param transition: Transition object -- used to calculate probability of transitioning between states
     :param emission: Emission object -- used to calculate probability of emitting each event in each state
     :param sentence: list of strings (words)
+    :param model: CompiledHMM object, built from transition and emission if not given
 
     :return: path: list(int) -- list of states in the most probable path
     :return: p: float -- probability of that path
     """
+    if model is None:
+        model = CompiledHMM(emission, transition)
+
     # List of arrays giving most likely previous state for each state.
     prev = []
 
-    # List of possible states and words, order here is preserved
-    state_list = list(emission.states)
-    word_list = emission.get_word_list()
-
-    # Making sentence indexed and iterable for easy traversal
-    smoothed_sentence = sentence.copy()
-    for i in range(len(sentence)):
-        if sentence[i] not in word_list:
-            smoothed_sentence[i] = '#UNK#'
-    indexed_sentence = [word_list.index(word) for word in smoothed_sentence]
-    iter_sentence = iter(indexed_sentence)
-    # print(indexed_sentence)
-
-    # List of start/stop tag probabilities
-    initial = []
-    final =[]
-    for state in state_list:
-        initial.append(transition.startwith(state))
-        final.append(transition.stopwith(state))
-
-    transition_matrix = transition.get_transition_matrix()
-    emission_matrix = emission.get_emission_param_matrix()
-
-    # Use log-likelihoods to avoid floating-point underflow. Ignore -inf.
-    with np.errstate(divide='ignore'):
-        initial = np.log10(initial)
-        transition_matrix = np.log10(transition_matrix)
-        emission_matrix = np.log10(emission_matrix)
-        final = np.log10(final)
+    # List of possible states, order here is preserved
+    state_list = model.states
+
+    # Making sentence indexed and iterable for easy traversal, unseen words are mapped to #UNK#
+    iter_sentence = iter(model.index(sentence))
+
+    # Log-likelihoods of start/stop tags, transitions and emissions
+    initial = model.log_start
+    transition_matrix = model.log_transition
+    emission_matrix = model.log_emission
+    final = model.log_stop
 
     logprob = initial + emission_matrix[:, next(iter_sentence)]
 
@@ -74,60 +71,286 @@ def best_path(transition, emission, sentence):
     return state_path, 10**logprob[best_state]
 
 
-def label_viterbi(input_file, output_file, emission, transition):
+def beam_mask(logprob, beam=None, threshold=None):
+    """
+    Choose the states kept by beam search at one position, for every row of logprob. The best state of a row
+    is always kept.
+
+    :param logprob: array(rows, states) -- log-prob of each state
+    :param beam: int -- number of states kept per row, None to not limit it
+    :param threshold: float -- states more than threshold below the best state of their row (in log10) are dropped,
+                      None to not drop any
+
+    :return: keep: array(rows, states) of bool -- True for the states kept
+    """
+    rows = np.arange(logprob.shape[0])
+    best = np.argmax(logprob, axis=1)
+    keep = np.ones(logprob.shape, dtype=bool)
+    if threshold is not None:
+        keep &= logprob >= logprob[rows, best][:, np.newaxis] - threshold
+    if beam is not None and beam < logprob.shape[1]:
+        top = np.argpartition(logprob, -beam, axis=1)[:, -beam:]
+        in_beam = np.zeros(logprob.shape, dtype=bool)
+        np.put_along_axis(in_beam, top, True, axis=1)
+        keep &= in_beam
+    keep[rows, best] = True
+    return keep
+
+
+def beam_indices(logprob, beam=None, threshold=None):
+    """
+    Same as beam_mask for a single row, as the indices of the states kept instead of a mask. Cheaper when
+    only a few states are kept.
+
+    :param logprob: array(states) -- log-prob of each state
+    :param beam: int -- number of states kept, None to not limit it
+    :param threshold: float -- states more than threshold below the best state (in log10) are dropped, None to not drop any
+
+    :return: kept: array of int -- indices of the states kept, in increasing order
+    """
+    if threshold is not None:
+        kept = np.flatnonzero(logprob >= logprob.max() - threshold)
+    else:
+        kept = np.arange(len(logprob))
+    if beam is not None and beam < len(kept):
+        kept = np.sort(kept[np.argpartition(logprob[kept], -beam)[-beam:]])
+    return kept
+
+
+def use_predecessors(model):
+    """
+    Whether decoding with the allowed predecessors of model is worth it. Scoring only the allowed transitions
+    takes a few more NumPy calls per word than the dense broadcast, so it is only used when at most
+    PREDECESSOR_DENSITY[model.order] of all transitions are allowed.
+
+    :param model: CompiledHMM object
+
+    :return: boolean
+    """
+    predecessors = model.predecessors
+    if predecessors is None or len(predecessors.indices) == 0:
+        return False
+    return len(predecessors.indices) <= PREDECESSOR_DENSITY[model.order] * model.log_transition.size
+
+
+def predecessor_max(scores, predecessors, columns):
+    """
+    Maximise scores over the allowed predecessors of each column, as np.max and np.argmax over a dense matrix
+    where every entry that is not allowed is -inf.
+
+    :param scores: array(..., entries) -- score of each stored entry of predecessors, in the same order
+    :param predecessors: SparseColumns -- allowed predecessors of each column, see CompiledHMM
+    :param columns: array(entries) of int -- column of each stored entry, see CompiledHMM.predecessor_columns
+
+    :return: best: array(..., columns) -- best score of each column, -inf for a column without predecessors
+    :return: argbest: array(..., columns) of int -- row of the best entry of each column, the first one on ties, and
+             0 where the best score is -inf
+    """
+    entries = len(columns)
+    shape = scores.shape[:-1] + (predecessors.shape[1],)
+    best = np.full(shape, -np.inf, dtype=scores.dtype)
+    argbest = np.zeros(shape, dtype=int)
+    # reduceat gives an empty segment the value at its start, so only the columns with entries are reduced.
+    # Their starts are increasing, and each segment ends where the next non-empty column starts.
+    nonempty = np.flatnonzero(np.diff(predecessors.indptr))
+    if len(nonempty) == 0:
+        return best, argbest
+    starts = predecessors.indptr[nonempty]
+    best[..., nonempty] = np.maximum.reduceat(scores, starts, axis=-1)
+    # First entry of each column reaching its best score
+    first = np.minimum.reduceat(np.where(scores == best[..., columns], np.arange(entries), entries), starts, axis=-1)
+    argbest[..., nonempty] = predecessors.indices[first]
+    # np.argmax over a dense column that is all -inf gives its first row
+    argbest[best == -np.inf] = 0
+    return best, argbest
+
+
+def index_sentences(model, sentences):
+    """
+    Convert a batch of sentences into a padded array of word indices.
+
+    :param model: CompiledHMM object -- provides the word index, unseen words are mapped to #UNK#
+    :param sentences: list of lists of strings (words)
+
+    :return: word_indices: array(batch, max_len) of int -- column of each word in the emission matrix, 0 after the end of a sentence
+    :return: mask: array(batch, max_len) of bool -- True where word_indices holds a word
+    """
+    max_len = max(len(sentence) for sentence in sentences)
+    word_indices = np.zeros((len(sentences), max_len), dtype=int)
+    mask = np.zeros((len(sentences), max_len), dtype=bool)
+
+    for i, sentence in enumerate(sentences):
+        word_indices[i, :len(sentence)] = model.index(sentence)
+        mask[i, :len(sentence)] = True
+
+    return word_indices, mask
+
+
+def batch_best_path(transition, emission, word_indices, mask, model=None, beam=None, threshold=None):
+    """
+    Find the likeliest path for every sentence in a batch at once. Each step of the recursion handles the same
+    position of all sentences with one broadcast over a (batch, S, S) array. Sentences that have already ended
+    keep their log-prob and point back to the same state. Returns the same paths as calling best_path on each
+    sentence.
+
+    With beam or threshold, only the states kept by beam_mask at one position are extended to the next, so
+    each step is a (batch, K, S) broadcast where K is the most states kept by a sentence of the batch. The
+    paths found may then differ from best_path.
+
+    :param transition: Transition object -- used to calculate probability of transitioning between states
+    :param emission: Emission object -- used to calculate probability of emitting each event in each state
+    :param word_indices: array(batch, max_len) of int -- see index_sentences
+    :param mask: array(batch, max_len) of bool -- True for the words of each sentence, False for the padding
+    :param model: CompiledHMM object, built from transition and emission if not given
+    :param beam: int -- number of states kept at each position, None to keep all
+    :param threshold: float -- drop states more than threshold below the best one at each position (in log10)
+
+    :return: paths: list(list(string)) -- most probable path of each sentence
+    :return: p: array(batch) -- probability of each path
+    """
+    if model is None:
+        model = CompiledHMM(emission, transition)
+    initial, transition_matrix, final, emission_matrix = model.log_start, model.log_transition, model.log_stop, model.log_emission
+
+    state_list = model.states
+    batch, max_len = word_indices.shape
+    rows = np.arange(batch)
+    stay = np.tile(np.arange(len(state_list)), (batch, 1))
+
+    logprob = initial + emission_matrix[:, word_indices[:, 0]].T
+
+    # List of arrays giving most likely previous state for each state of each sentence.
+    prev = []
+    pruned = beam is not None or threshold is not None
+    sparse = not pruned and use_predecessors(model)
+    if sparse:
+        predecessors, columns = model.predecessors, model.predecessor_columns
+        # Log-prob of every allowed transition u -> v, in the order of the entries of predecessors
+        allowed_transitions = predecessors.data
+    for t in range(1, max_len):
+        active = mask[:, t, np.newaxis]
+        emission_t = emission_matrix[:, word_indices[:, t]].T
+        if sparse:
+            # Only the allowed predecessors u of each state v are scored
+            scores = logprob[:, predecessors.indices] + allowed_transitions + emission_t[:, columns]
+            step_logprob, best = predecessor_max(scores, predecessors, columns)
+        elif pruned:
+            # Kept states of each sentence first, padded with dropped states at -inf up to the widest beam
+            keep = beam_mask(logprob, beam, threshold)
+            kept = np.argsort(~keep, axis=1, kind='stable')[:, :keep.sum(axis=1).max()]
+            kept_logprob = np.where(np.take_along_axis(keep, kept, axis=1), np.take_along_axis(logprob, kept, axis=1), -np.inf)
+            p = kept_logprob[:, :, np.newaxis] + transition_matrix[kept] + emission_t[:, np.newaxis, :]
+            best = np.take_along_axis(kept, np.argmax(p, axis=1), axis=1)
+            step_logprob = np.max(p, axis=1)
+            if PROFILER.enabled:
+                PROFILER.count('states_explored', int(keep[active[:, 0]].sum()))
+        else:
+            p = logprob[:, :, np.newaxis] + transition_matrix + emission_t[:, np.newaxis, :]
+            best = np.argmax(p, axis=1)
+            step_logprob = np.max(p, axis=1)
+        prev.append(np.where(active, best, stay))
+        logprob = np.where(active, step_logprob, logprob)
+
+    # Final case, every state of the last word of each sentence is scored
+    logprob = logprob + final
+    if pruned and PROFILER.enabled:
+        PROFILER.count('states_explored', batch * len(state_list))
+
+    # Most likely final state
+    best_state = np.argmax(logprob, axis=1)
+    best_logprob = logprob[rows, best_state]
+
+    # Reconstruct paths by following links backwards, padding positions point to the same state
+    path = np.zeros((batch, max_len), dtype=int)
+    state = best_state
+    path[:, max_len - 1] = state
+    for t in range(max_len - 1, 0, -1):
+        state = prev[t - 1][rows, state]
+        path[:, t - 1] = state
+
+    # Converting paths of ints into states, the last state of each sentence is the most likely final state
+    lengths = mask.sum(axis=1)
+    paths = []
+    for i in range(batch):
+        paths.append([state_list[s] for s in path[i, :lengths[i]]])
+    return paths, 10**best_logprob
+
+
+def decode_batch(model, batch, beam=None, threshold=None):
+    """
+    Find the likeliest path of every sentence in a batch with batch_best_path, or with best_path for a single
+    sentence, where it has less overhead for the same path.
+
+    :param model: CompiledHMM object of order 1
+    :param batch: list of lists of strings (words)
+    :param beam: int -- number of states kept at each position, None to keep all
+    :param threshold: float -- drop states more than threshold below the best one at each position (in log10)
+
+    :return: paths: list(list(string)) -- most probable path of each sentence
+    """
+    with PROFILER.stage('decode'):
+        start = time.perf_counter()
+        word_indices, mask = index_sentences(model, batch)
+        single = beam is None and threshold is None and len(batch) == 1
+        if single:
+            paths = [best_path(None, None, batch[0], model)[0]]
+        else:
+            paths = batch_best_path(None, None, word_indices, mask, model, beam, threshold)[0]
+        seconds = time.perf_counter() - start
+    if PROFILER.enabled:
+        # A pruned decoder counts the states it keeps itself
+        pruned = beam is not None or threshold is not None
+        count_decoded(model, batch, word_indices[mask], 0 if pruned else len(model.states) * int(mask.sum()),
+                      seconds, [seconds] if single else None)
+    return paths
+
+
+def label_viterbi(input_file, output_file, emission, transition, batch_size=1000, workers=1, model=None, beam=None, threshold=None):
+        if model is None:
+            model = CompiledHMM(emission, transition)
+
+        def decode(batch):
+            return decode_batch(model, batch, beam, threshold)
+
+        stats = None
         try:
-            tweet_list = open(input_file, 'r',  encoding="UTF-8")
-            output_file = open(output_file, "w+", encoding="UTF-8")
-            lines = tweet_list.readlines()
-
-            sentence = []
-            for line in lines:
-                if line == "\n":
-                    path, prob = best_path(transition, emission, sentence)
-                    for i in range(len(sentence)):
-                        output_file.write("{} {}".format(sentence[i], path[i]))
-                        output_file.write('\n')
-                    sentence.clear()
-                    output_file.write('\n')
-
-                else:
-                    sentence.append(line.rstrip())
+            stats = label_file(input_file, output_file, decode, batch_size, workers=workers)
 
         except IOError:
             print(IOError)
 
         finally:
-            tweet_list.close()
-            output_file.close()
             print("Sequence Labelling for", input_file, "completed. Results are saved in", output_file)
+        return stats
 
 
-from preprocess import Preprocessor
 from evaluateResult import evaluate
+from model_cache import ModelCache
 
 
-def train_and_validate_viterbi(_inputFile, _outputFile, _devFile, _devOutputFile, _validateFile):
+def train_and_validate_viterbi(_inputFile, _outputFile, _devFile, _devOutputFile, _validateFile, workers=1, model_dir=None, cache=None,
+                               beam=None, threshold=None):
     """
-    Create the Preprocessor object
-    Train using the SG, EN, CN, FR datasets
-    Generate the representer, vocabulary and states and feed it into an Emission object
+    Load the model saved in model_dir if there is one
+    Otherwise get the model from the cache, which parses and trains on the SG, EN, CN, FR datasets
+    only if they have not been trained on before, and save it to model_dir if given
     """
-    preprocessor = Preprocessor(_inputFile)
-    representer = preprocessor.get_representer()
-    vocabulary = preprocessor.get_vocabulary()
-    states = preprocessor.get_states()
+    if model_dir is not None and CompiledHMM.exists(model_dir):
+        print("Loading saved model from", model_dir)
+        model = CompiledHMM.load(model_dir)
+    else:
+        if cache is None:
+            cache = ModelCache()
+        model = cache.compiled_model(_inputFile, 1)
+        if model_dir is not None:
+            model.save(model_dir)
 
 
     """
-    Create the Emission and Transition objects
     Validate using the dev datasets
     Label the input sequence and output the file as dev.p3.out
     """
-    emission = Emission(representer, vocabulary, states)
-    transition = Transition()
-    transition.compute_params(preprocessor)
-
-    label_viterbi(_devFile, _devOutputFile, emission, transition)
+    label_viterbi(_devFile, _devOutputFile, None, None, workers=workers, model=model, beam=beam, threshold=threshold)
 
     """
     Calculate Validation Error
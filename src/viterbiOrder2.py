@@ -1,6 +1,12 @@
 from transitionOrder2 import Transition2
 from emission import Emission
+from compiled_hmm import CompiledHMM
+from pipeline import label_file
+from profiler import PROFILER
+from emission import count_decoded
+from viterbi import beam_indices, index_sentences, use_predecessors, predecessor_max
 import numpy as np
+import time
 
 
 def best_path(transition, emission, sentence):
@@ -17,16 +23,11 @@ def best_path(transition, emission, sentence):
     # List of arrays giving most likely previous state for each state.
     prev = []
 
-    # List of possible states and words, order here is preserved
+    # List of possible states, order here is preserved
     state_list = list(emission.states)
-    word_list = emission.get_word_list()
-
-    # Making sentence indexed and iterable for easy traversal
-    smoothed_sentence = sentence.copy()
-    for i in range(len(sentence)):
-        if sentence[i] not in word_list:
-            smoothed_sentence[i] = '#UNK#'
-    indexed_sentence = [word_list.index(word) for word in smoothed_sentence]
+
+    # Making sentence indexed and iterable for easy traversal, unseen words are mapped to #UNK#
+    indexed_sentence = [emission.word_column(word) for word in sentence]
     iter_sentence = iter(indexed_sentence)
     # print(indexed_sentence)
 
@@ -115,64 +116,284 @@ def best_path(transition, emission, sentence):
     # print(path)
     # Converting path list of ints into states
     state_path = [state_list_order2[i][1] for i in path[::-1]]
-    print(state_path)
     return state_path, 10**logprob[best_state]
 
 
-def label_viterbi(input_file, output_file, emission, transition):
-        try:
-            tweet_list = open(input_file, 'r',  encoding="UTF-8")
-            output_file = open(output_file, "w+", encoding="UTF-8")
-            lines = tweet_list.readlines()
-
-            sentence = []
-            for line in lines:
-                if line == "\n":
-                    path, prob = best_path(transition, emission, sentence)
-                    for i in range(len(sentence)):
-                        output_file.write("{} {}".format(sentence[i], path[i]))
-                        output_file.write('\n')
-                    sentence.clear()
-                    output_file.write('\n')
+def fast_best_path(transition, emission, sentence, model=None, beam=None, threshold=None):
+    """
+    Vectorized version of best_path. Instead of looping over every pair of order 2 states, the log-prob of
+    every (u, v) pair is held in an S x S array and each word is a single broadcast over the (t, u, v) tensor,
+    maximised over t. Returns the same path as best_path.
 
-                else:
-                    sentence.append(line.rstrip())
+    With beam or threshold, only the pairs (t, u) kept by beam_indices at one position are extended to the next,
+    so each word scores K x S transitions instead of S x S x S. Pairs (u, v) that no kept pair leads to are
+    dropped. The path found may then differ from best_path.
+
+    :param transition: Transition2 object -- used to calculate probability of transitioning between states
+    :param emission: Emission object -- used to calculate probability of emitting each event in each state
+    :param sentence: list of strings (words)
+    :param model: CompiledHMM object, built from transition and emission if not given
+    :param beam: int -- number of pairs of states kept at each position, None to keep all
+    :param threshold: float -- drop pairs more than threshold below the best one at each position (in log10)
+
+    :return: path: list(string) -- list of states in the most probable path
+    :return: p: float -- probability of that path
+    """
+    if model is None:
+        model = CompiledHMM(emission, transition)
+    start, start_u, transition_tensor = model.log_start, model.log_start_u, model.log_transition
+    final, emission_matrix = model.log_stop, model.log_emission
+
+    # List of possible states, order here is preserved
+    state_list = model.states
+
+    # Making sentence indexed for easy traversal, unseen words are mapped to #UNK#
+    indexed_sentence = model.index(sentence)
+
+    # first iteration
+    logprob_start = start + emission_matrix[:, indexed_sentence[0]]
+    if len(indexed_sentence) == 1:
+        if (beam is not None or threshold is not None) and PROFILER.enabled:
+            PROFILER.count('states_explored', len(state_list))
+        best_state = np.argmax(logprob_start)
+        return [state_list[best_state]], 10**logprob_start[best_state]
+
+    # second iteration, logprob[u, v] for the first two words
+    logprob = logprob_start[:, np.newaxis] + start_u + emission_matrix[:, indexed_sentence[1]]
+
+    # recursive iteration, prev[i][u, v] stores the best state t preceding (u, v)
+    prev = []
+    pruned = beam is not None or threshold is not None
+    n = len(state_list)
+    transition_rows = transition_tensor.reshape(n * n, n)
+    for word in indexed_sentence[2:]:
+        if pruned:
+            # p[k, v] scores the kept pair k = (t, u) followed by v, which leads to the pair (u, v)
+            flat = logprob.ravel()
+            kept = beam_indices(flat, beam, threshold)
+            ts, us = np.divmod(kept, n)
+            p = flat[kept][:, np.newaxis] + transition_rows[kept] + emission_matrix[:, word]
+            logprob = np.full((n, n), -np.inf)
+            np.maximum.at(logprob, us, p)
+
+            # Back pointer of (u, v) is the t of the best kept pair, the first one on ties as with argmax.
+            # Pointers are written in reverse so that the first kept pair is written last.
+            back = np.zeros((n, n), dtype=int)
+            k, v = np.nonzero(p == logprob[us])
+            back[us[k[::-1]], v[::-1]] = ts[k[::-1]]
+            prev.append(back)
+            if PROFILER.enabled:
+                PROFILER.count('states_explored', len(kept))
+        else:
+            p = logprob[:, :, np.newaxis] + transition_tensor + emission_matrix[:, word]
+            prev.append(np.argmax(p, axis=0))
+            logprob = np.max(p, axis=0)
+
+    # Final case, every pair of the last two words is scored
+    logprob = logprob + final
+    if pruned and PROFILER.enabled:
+        PROFILER.count('states_explored', n + n * n)
+
+    # Most likely final pair of states
+    u, v = np.unravel_index(np.argmax(logprob), logprob.shape)
+    best_logprob = logprob[u, v]
+
+    # Reconstruct path by following links and then reversing
+    path = [v, u]
+    for p in reversed(prev):
+        u, v = p[u, v], u
+        path.append(u)
+
+    # Converting path list of ints into states
+    state_path = [state_list[i] for i in path[::-1]]
+    return state_path, 10**best_logprob
+
+
+def batch_best_path(transition, emission, word_indices, mask, model=None):
+    """
+    Find the likeliest path for every sentence in a batch at once, as fast_best_path does for one sentence.
+    Sentences are sorted by decreasing length, so the sentences still running at a position are the first
+    rows and ended sentences are not scored.
+
+    When few transitions were seen in the train data, see use_predecessors, each step only scores the seen
+    transitions (t, u) -> v of each pair (u, v). Every other transition has the same smoothed probability
+    log_floor[u, v] (or is forbidden), so the best of them starts from the best pair (t, u) of each u. This
+    gives the same paths as the dense (batch, S, S, S) broadcast.
+
+    :param transition: Transition2 object -- used to calculate probability of transitioning between states
+    :param emission: Emission object -- used to calculate probability of emitting each event in each state
+    :param word_indices: array(batch, max_len) of int -- see viterbi.index_sentences
+    :param mask: array(batch, max_len) of bool -- True for the words of each sentence, False for the padding
+    :param model: CompiledHMM object, built from transition and emission if not given
+
+    :return: paths: list(list(string)) -- most probable path of each sentence
+    :return: p: array(batch) -- probability of each path
+    """
+    if model is None:
+        model = CompiledHMM(emission, transition)
+    start, start_u, transition_tensor = model.log_start, model.log_start_u, model.log_transition
+    final, emission_matrix = model.log_stop, model.log_emission
+    state_list = model.states
+    n = len(state_list)
+
+    # Longest sentences first, rows[:k] are the sentences with more than t words at position t
+    lengths = mask.sum(axis=1)
+    order = np.argsort(-lengths, kind='stable')
+    word_indices, lengths = word_indices[order], lengths[order]
+    batch, max_len = word_indices.shape
+    rows = np.arange(batch)
+    running = [int(np.count_nonzero(lengths > t)) for t in range(max(max_len, 2))]
+
+    # first iteration
+    logprob_start = start + emission_matrix[:, word_indices[:, 0]].T
+
+    # second iteration, logprob[i, u, v] for the first two words of each sentence
+    k = running[1]
+    second_words = word_indices[:k, 1] if max_len > 1 else word_indices[:0, 0]
+    logprob = logprob_start[:k, :, np.newaxis] + start_u + emission_matrix[:, second_words].T[:, np.newaxis, :]
+
+    sparse = use_predecessors(model)
+    if sparse:
+        predecessors, columns, log_floor = model.predecessors, model.predecessor_columns, model.log_floor
+        # Every seen (t, u) -> v reads the log-prob of the pair (t, u) and the emission of v
+        pair_of_entry = predecessors.indices * n + columns // n
+        state_of_entry = columns % n
+
+    # recursive iteration, prev[t - 2][i, u, v] stores the best state preceding (u, v) at positions t - 1, t
+    prev = []
+    state_dtype = np.min_scalar_type(n)
+    for t in range(2, max_len):
+        k = running[t]
+        current = logprob[:k]
+        emission_t = emission_matrix[:, word_indices[:k, t]].T
+        if sparse:
+            scores = current.reshape(k, n * n)[:, pair_of_entry] + predecessors.data + emission_t[:, state_of_entry]
+            seen_logprob, seen_t = predecessor_max(scores, predecessors, columns)
+            seen_logprob, seen_t = seen_logprob.reshape(k, n, n), seen_t.reshape(k, n, n)
+            floor_t = np.argmax(current, axis=1)
+            floor_logprob = np.take_along_axis(current, floor_t[:, np.newaxis, :], axis=1)[:, 0, :, np.newaxis] + log_floor + emission_t[:, np.newaxis, :]
+            floor_t = floor_t[:, :, np.newaxis]
+            # argmax over t takes the first t on ties
+            back = np.where(seen_logprob > floor_logprob, seen_t,
+                            np.where(seen_logprob < floor_logprob, floor_t, np.minimum(seen_t, floor_t)))
+            logprob[:k] = np.maximum(seen_logprob, floor_logprob)
+        else:
+            p = current[:, :, :, np.newaxis] + transition_tensor + emission_t[:, np.newaxis, np.newaxis, :]
+            back = np.argmax(p, axis=1)
+            logprob[:k] = np.max(p, axis=1)
+        prev.append(back.astype(state_dtype))
+
+    # Final case, a sentence of one word has no stop probability as in fast_best_path
+    path = np.zeros((batch, max_len), dtype=int)
+    best_logprob = np.zeros(batch)
+    k = running[1]
+    single = np.arange(k, batch)
+    path[single, 0] = np.argmax(logprob_start[k:], axis=1)
+    best_logprob[k:] = logprob_start[single, path[single, 0]]
+
+    # Most likely final pair of states of every longer sentence
+    logprob = (logprob + final).reshape(k, n * n)
+    best_pair = np.argmax(logprob, axis=1)
+    best_logprob[:k] = logprob[rows[:k], best_pair]
+    path[rows[:k], lengths[:k] - 2], path[rows[:k], lengths[:k] - 1] = np.divmod(best_pair, n)
+
+    # Reconstruct paths by following links backwards from the end of each sentence
+    for t in range(max_len - 1, 1, -1):
+        k = running[t]
+        path[:k, t - 2] = prev[t - 2][rows[:k], path[:k, t - 1], path[:k, t]]
+
+    # Converting paths of ints into states, in the original order of the sentences
+    paths = [None] * batch
+    probabilities = np.zeros(batch)
+    for i in range(batch):
+        paths[order[i]] = [state_list[s] for s in path[i, :lengths[i]]]
+        probabilities[order[i]] = 10**best_logprob[i]
+    return paths, probabilities
+
+
+def decode_batch(model, batch, beam=None, threshold=None):
+    """
+    Find the likeliest path of every sentence in a batch, with batch_best_path, or with fast_best_path for each
+    sentence when decoding with a beam or a single sentence, where it has less overhead for the same path.
+
+    :param model: CompiledHMM object of order 2
+    :param batch: list of lists of strings (words)
+    :param beam: int -- number of pairs of states kept at each position, None to keep all
+    :param threshold: float -- drop pairs more than threshold below the best one at each position (in log10)
+
+    :return: paths: list(list(string)) -- most probable path of each sentence
+    """
+    with PROFILER.stage('decode'):
+        batch_start = time.perf_counter()
+        sentence_seconds = None
+        if beam is None and threshold is None and len(batch) > 1:
+            word_indices, mask = index_sentences(model, batch)
+            paths = batch_best_path(None, None, word_indices, mask, model)[0]
+        else:
+            paths = []
+            sentence_seconds = []
+            for sentence in batch:
+                start = time.perf_counter()
+                paths.append(fast_best_path(None, None, sentence, model, beam, threshold)[0])
+                sentence_seconds.append(time.perf_counter() - start)
+        seconds = time.perf_counter() - batch_start
+    if PROFILER.enabled:
+        # The first word of a sentence scores every state, every later word every pair of states,
+        # a pruned decoder counts the pairs it keeps itself
+        n = len(model.states)
+        pruned = beam is not None or threshold is not None
+        count_decoded(model, batch, model.index([word for sentence in batch for word in sentence]),
+                      0 if pruned else sum(n + (len(sentence) - 1) * n * n for sentence in batch),
+                      seconds, sentence_seconds)
+    return paths
+
+
+def label_viterbi(input_file, output_file, emission, transition, batch_size=1000, workers=1, model=None, beam=None, threshold=None):
+        if model is None:
+            model = CompiledHMM(emission, transition)
+
+        def decode(batch):
+            return decode_batch(model, batch, beam, threshold)
+
+        stats = None
+        try:
+            stats = label_file(input_file, output_file, decode, batch_size, workers=workers)
 
         except IOError:
             print(IOError)
 
         finally:
-            tweet_list.close()
-            output_file.close()
             print("Sequence Labelling for", input_file, "completed. Results are saved in", output_file)
+        return stats
 
 
-from preprocess import Preprocessor
 from evaluateResult import evaluate
+from model_cache import ModelCache
 
 
-def train_and_validate_viterbi2(_inputFile, _outputFile, _devFile, _devOutputFile, _validateFile):
+def train_and_validate_viterbi2(_inputFile, _outputFile, _devFile, _devOutputFile, _validateFile, workers=1, model_dir=None, cache=None,
+                                beam=None, threshold=None):
     """
-    Create the Preprocessor object
-    Train using the SG, EN, CN, FR datasets
-    Generate the representer, vocabulary and states and feed it into an Emission object
+    Load the model saved in model_dir if there is one
+    Otherwise get the model from the cache, which parses and trains on the SG, EN, CN, FR datasets
+    only if they have not been trained on before, and save it to model_dir if given
     """
-    preprocessor = Preprocessor(_inputFile)
-    representer = preprocessor.get_representer()
-    vocabulary = preprocessor.get_vocabulary()
-    states = preprocessor.get_states()
+    if model_dir is not None and CompiledHMM.exists(model_dir):
+        print("Loading saved model from", model_dir)
+        model = CompiledHMM.load(model_dir)
+    else:
+        if cache is None:
+            cache = ModelCache()
+        model = cache.compiled_model(_inputFile, 2)
+        if model_dir is not None:
+            model.save(model_dir)
 
 
     """
-    Create the Emission and Transition objects
     Validate using the dev datasets
-    Label the input sequence and output the file as dev.p3.out
+    Label the input sequence and output the file as dev.p4.out
     """
-    emission = Emission(representer, vocabulary, states)
-    transition = Transition2()
-    transition.compute_params(preprocessor)
-
-    label_viterbi(_devFile, _devOutputFile, emission, transition)
+    label_viterbi(_devFile, _devOutputFile, None, None, workers=workers, model=model, beam=beam, threshold=threshold)
 
     """
     Calculate Validation Error
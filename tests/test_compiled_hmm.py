@@ -0,0 +1,90 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+from compiled_hmm import CompiledHMM, TABLES, SPARSE_PARTS, BIO_PENALTY
+from emission import Emission
+from preprocess import Preprocessor, read_sentences
+from sparse_columns import SparseColumns
+from transition import Transition, bio_transitions
+from transitionOrder2 import Transition2, SMOOTHING
+import viterbi
+import viterbiOrder2
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def compile_model(order, sparse=False, bio=False):
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor(os.path.join(DATA, "EN", "train"))
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states(),
+                            sparse=sparse)
+        transition = None
+        if order == 1:
+            transition = Transition()
+            transition.compute_params(preprocessor)
+        elif order == 2:
+            transition = Transition2()
+            transition.compute_params(preprocessor)
+    return CompiledHMM(emission, transition, bio=bio)
+
+
+def assert_same_table(table, expected):
+    if expected is None:
+        assert table is None
+    elif isinstance(expected, SparseColumns):
+        assert isinstance(table, SparseColumns)
+        assert table.shape == expected.shape
+        for part in SPARSE_PARTS:
+            np.testing.assert_array_equal(getattr(table, part), getattr(expected, part))
+    else:
+        assert table.dtype == expected.dtype
+        np.testing.assert_array_equal(table, expected)
+
+
+@pytest.mark.parametrize("order, sparse, bio", [(0, False, False), (1, False, False), (2, False, False),
+                                                (1, True, False), (2, True, False), (1, False, True),
+                                                (2, False, True)])
+@pytest.mark.parametrize("mmap_mode", ["r", None])
+def test_save_load_round_trip(tmp_path, order, sparse, bio, mmap_mode):
+    model = compile_model(order, sparse, bio)
+    model.save(str(tmp_path))
+    loaded = CompiledHMM.load(str(tmp_path), mmap_mode=mmap_mode)
+
+    assert loaded.order == model.order
+    assert loaded.states == model.states
+    assert loaded.word_list == model.word_list
+    assert loaded.word_index == model.word_index
+    assert loaded.unk == model.unk
+    for name in TABLES:
+        assert_same_table(getattr(loaded, name), getattr(model, name))
+    # The allowed predecessors are not saved, load derives them from the tables
+    assert_same_table(loaded.predecessors, model.predecessors)
+    assert_same_table(loaded.predecessor_columns, model.predecessor_columns)
+    assert_same_table(loaded.log_floor, model.log_floor)
+
+
+def test_bio_only_penalises_unseen_transitions():
+    model, bio_model = compile_model(2), compile_model(2, bio=True)
+    allowed = bio_transitions(model.states)[np.newaxis, :, :]
+    seen = model.log_transition > np.log10(SMOOTHING)
+    penalised = ~seen & ~allowed
+
+    # The train data has seen transitions breaking BIO constraints, such as O -> I-NP, they keep their probability
+    assert (seen & ~allowed).any()
+    np.testing.assert_array_equal(bio_model.log_transition[~penalised], model.log_transition[~penalised])
+    np.testing.assert_allclose(bio_model.log_transition[penalised], model.log_transition[penalised] + np.log10(BIO_PENALTY))
+    for name in ("log_start", "log_start_u", "log_stop"):
+        np.testing.assert_array_equal(getattr(bio_model, name), getattr(model, name))
+
+
+def test_bio_keeps_dev_paths():
+    model, bio_model = compile_model(2), compile_model(2, bio=True)
+    sentences = [tokens for tokens, tags in read_sentences(os.path.join(DATA, "EN", "dev.in"), labelled=False)]
+    word_indices, mask = viterbi.index_sentences(model, sentences)
+
+    paths = viterbiOrder2.batch_best_path(None, None, word_indices, mask, model)[0]
+    assert viterbiOrder2.batch_best_path(None, None, word_indices, mask, bio_model)[0] == paths
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from emission import Emission
+from preprocess import Preprocessor, read_sentences
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def build_emission(language):
+    preprocessor = Preprocessor(os.path.join(DATA, language, "train"))
+    return Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+
+
+def resummed_total(emission, state, smooth):
+    """The total of a tag as count_total computed it before the totals were cached."""
+    total = sum(emission.representer[state].values())
+    if smooth:
+        total += emission.smoothing_param
+    return total
+
+
+def query_words(emission, language):
+    dev_words = [word for tokens, tags in read_sentences(os.path.join(DATA, language, "dev.in"), labelled=False)
+                 for word in tokens]
+    # Train words, #UNK#, and dev words that may not be in train
+    return list(emission.vocabulary) + list(dict.fromkeys(dev_words)) + ["#never-seen#"]
+
+
+def assert_same_params(emission, words):
+    for smooth in (True, False):
+        for state in emission.states:
+            total = resummed_total(emission, state, smooth)
+            for word in words:
+                assert emission.estimate_emission_param(word, state, smooth) == emission.count(word, state, smooth) / total
+
+
+@pytest.mark.parametrize("language", ["EN", "SG"])
+def test_cached_totals_match_resummed_counts(language):
+    emission = build_emission(language)
+    words = query_words(emission, language)
+
+    assert_same_params(emission, words)
+
+    for k in (0.5, 3):
+        emission.setSmoothingParam(k)
+        assert_same_params(emission, words)
+
+
+def test_totals_follow_smoothing_param():
+    emission = build_emission("EN")
+    for k in (1, 0.5, 3):
+        emission.setSmoothingParam(k)
+        for state in emission.states:
+            assert emission.count_total(state, smooth=False) == resummed_total(emission, state, False)
+            assert emission.count_total(state, smooth=True) == resummed_total(emission, state, True)
@@ -0,0 +1,36 @@
+import contextlib
+import io
+import os
+
+from model_cache import ModelCache
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def cached_models(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if os.path.isfile(os.path.join(cache_dir, name, "model.json")))
+
+
+def compiled_model(cache_dir, max_bytes, language, order):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        ModelCache(str(cache_dir), max_bytes).compiled_model(os.path.join(DATA, language, "train"), order)
+    return output.getvalue()
+
+
+def test_model_larger_than_cache_is_kept(tmp_path):
+    compiled_model(tmp_path, 1, "EN", 1)
+    assert len(cached_models(tmp_path)) == 1
+
+    # The next run loads it instead of training again
+    assert "Loaded cached model" in compiled_model(tmp_path, 1, "EN", 1)
+
+
+def test_least_recently_used_models_make_room_for_the_new_one(tmp_path):
+    compiled_model(tmp_path, 1, "EN", 0)
+    first = cached_models(tmp_path)
+    compiled_model(tmp_path, 1, "EN", 1)
+    second = cached_models(tmp_path)
+
+    assert len(second) == 1
+    assert second != first
@@ -0,0 +1,124 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+from compiled_hmm import CompiledHMM
+from emission import Emission
+from preprocess import Preprocessor, read_sentences
+from sparse_columns import SparseColumns
+from transition import Transition
+from transitionOrder2 import Transition2
+import viterbi
+import viterbiOrder2
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+# C is the last tag and only starts sentences, so no tag ever comes before it: the column of C (order 1) and
+# of every pair (u, C) (order 2) has no predecessors, including the last column of predecessors
+TRAILING_EMPTY_TRAIN = "a A\nb B\na A\n\nb B\na A\nb B\n\nc C\na A\nb B\n\nc C\nb B\n\n"
+
+
+def column_entries(predecessors):
+    return np.repeat(np.arange(predecessors.shape[1]), np.diff(predecessors.indptr))
+
+
+def dense_max(scores, predecessors):
+    """np.max and np.argmax over the dense matrix of scores, -inf where an entry is not stored."""
+    dense = np.full(scores.shape[:-1] + predecessors.shape, -np.inf)
+    rows = predecessors.indices.astype(int)
+    dense[..., rows, column_entries(predecessors)] = scores
+    return dense.max(axis=-2), dense.argmax(axis=-2)
+
+
+def compile_model(train_file, order, bio=False):
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor(train_file)
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+        transition = Transition2() if order == 2 else Transition()
+        transition.compute_params(preprocessor)
+    return CompiledHMM(emission, transition, bio=bio)
+
+
+@pytest.fixture(params=["EN", "trailing_empty"])
+def train_file(request, tmp_path):
+    if request.param == "EN":
+        return os.path.join(DATA, "EN", "train")
+    path = tmp_path / "train"
+    path.write_text(TRAILING_EMPTY_TRAIN, encoding="utf-8")
+    return str(path)
+
+
+def test_predecessor_max_with_trailing_empty_column():
+    predecessors = SparseColumns.from_entries([0, 1, 2, 0, 1], [0, 0, 0, 1, 1], np.zeros(5), np.zeros(3), (3, 3))
+    scores = np.array([1., 2., 3., 4., 9.])
+
+    best, argbest = viterbi.predecessor_max(scores, predecessors, column_entries(predecessors))
+
+    np.testing.assert_array_equal(best, [3., 9., -np.inf])
+    np.testing.assert_array_equal(argbest[:2], [2, 1])
+
+
+@pytest.mark.parametrize("empty_columns", [[], [0], [5], [0, 2, 5], [2, 3], [0, 1, 2, 3, 4, 5]])
+def test_predecessor_max_matches_dense_max(empty_columns):
+    rng = np.random.default_rng(len(empty_columns))
+    allowed = rng.random((4, 6)) < 0.6
+    allowed[0] |= True
+    allowed[:, empty_columns] = False
+    rows, columns = np.nonzero(allowed)
+    predecessors = SparseColumns.from_entries(rows, columns, np.zeros(len(rows)), np.zeros(4), (4, 6))
+    # Rounded so that some columns have ties, which go to the first row as with np.argmax
+    scores = np.round(rng.normal(size=(3, len(rows))))
+    if len(rows):
+        scores[0, :2] = -np.inf
+        # The last entry is the best of its column, which a clamped reduceat start would cut off
+        scores[1:, -1] = 10
+
+    best, argbest = viterbi.predecessor_max(scores, predecessors, column_entries(predecessors))
+    expected_best, expected_argbest = dense_max(scores, predecessors)
+
+    np.testing.assert_array_equal(best, expected_best)
+    finite = np.isfinite(expected_best)
+    np.testing.assert_array_equal(argbest[finite], expected_argbest[finite])
+
+
+def test_trailing_empty_train_has_trailing_empty_columns(tmp_path):
+    path = tmp_path / "train"
+    path.write_text(TRAILING_EMPTY_TRAIN, encoding="utf-8")
+    for order in (1, 2):
+        model = compile_model(str(path), order)
+        assert model.states[-1] == "C"
+        assert model.predecessors.indptr[-1] == model.predecessors.indptr[-2]
+
+
+@pytest.mark.parametrize("bio", [False, True])
+@pytest.mark.parametrize("order, module", [(1, viterbi), (2, viterbiOrder2)])
+def test_sparse_decoding_matches_dense_decoding(monkeypatch, train_file, order, module, bio):
+    model = compile_model(train_file, order, bio)
+    sentences = [tokens for tokens, tags in read_sentences(os.path.join(DATA, "EN", "dev.in"), labelled=False)]
+    sentences += [["c", "a", "b"], ["a", "c"], ["c"], ["b", "c", "c", "a"]]
+    word_indices, mask = viterbi.index_sentences(model, sentences)
+
+    results = {}
+    for sparse in (False, True):
+        monkeypatch.setattr(module, "use_predecessors", lambda model: sparse)
+        results[sparse] = module.batch_best_path(None, None, word_indices, mask, model)
+
+    assert results[True][0] == results[False][0]
+    np.testing.assert_allclose(results[True][1], results[False][1], rtol=1e-9)
+
+
+def test_batched_order2_matches_fast_best_path(train_file):
+    model = compile_model(train_file, 2)
+    sentences = [tokens for tokens, tags in read_sentences(os.path.join(DATA, "EN", "dev.in"), labelled=False)]
+    sentences += [["c", "a", "b"], ["a", "c"], ["c"]]
+    word_indices, mask = viterbi.index_sentences(model, sentences)
+
+    paths, probabilities = viterbiOrder2.batch_best_path(None, None, word_indices, mask, model)
+
+    for sentence, path, probability in zip(sentences, paths, probabilities):
+        expected_path, expected_probability = viterbiOrder2.fast_best_path(None, None, sentence, model)
+        assert path == expected_path
+        assert probability == pytest.approx(expected_probability, rel=1e-9)
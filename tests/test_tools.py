@@ -0,0 +1,14 @@
+from tools import Dataset
+
+
+def test_dataset_keeps_every_field_before_the_tag_in_the_word(tmp_path):
+    # A line with more than one space is split as in Preprocessor: the last field is the tag and the word
+    # is the fields before it joined by a space, where Dataset used to keep only the first field
+    path = tmp_path / "train"
+    path.write_text("New York B-NP\nis B-VP\n\n: ) O\n\n", encoding="utf-8")
+
+    dataset = Dataset(str(path))
+
+    assert dataset.data == [["New York", "is"], [": )"]]
+    assert dataset.labels == [["B-NP", "B-VP"], ["O"]]
+    assert dataset.tags == ["B-NP", "B-VP", "O"]
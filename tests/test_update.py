@@ -0,0 +1,110 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+from emission import Emission
+from preprocess import Preprocessor, read_sentences
+from smoothed_emission import SmoothedEmission, getAllTokens
+from transition import Transition
+from transitionOrder2 import Transition2
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+# Number of train sentences left out of the first training, then added with update
+HELD_OUT = 100
+
+
+def split_train(language, tmp_path):
+    """Write the train file without its last HELD_OUT sentences, and return it with the sentences left out."""
+    train = os.path.join(DATA, language, "train")
+    with open(train, encoding="utf-8") as f:
+        blocks = [block for block in f.read().split("\n\n") if block.strip()]
+    head = tmp_path / "train"
+    head.write_text("\n\n".join(blocks[:-HELD_OUT]) + "\n\n", encoding="utf-8")
+    held_out = list(read_sentences(train))[-HELD_OUT:]
+    return str(head), train, held_out
+
+
+def preprocess(path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Preprocessor(path)
+
+
+def train_transition(cls, path):
+    transition = cls()
+    with contextlib.redirect_stdout(io.StringIO()):
+        transition.compute_params(preprocess(path))
+    return transition
+
+
+def state_order(updated, retrained):
+    """Row of every state of retrained in updated, the states may be listed in another order."""
+    assert sorted(updated) == sorted(retrained)
+    return np.array([list(updated).index(state) for state in retrained])
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_emission_update_matches_retraining(tmp_path, sparse):
+    head, train, held_out = split_train("EN", tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        p = preprocess(head)
+        updated = Emission(p.get_representer(), p.get_vocabulary(), p.get_states(), sparse=sparse)
+        updated.update(held_out)
+        p = preprocess(train)
+        retrained = Emission(p.get_representer(), p.get_vocabulary(), p.get_states(), sparse=sparse)
+
+    rows = state_order(updated.states, retrained.states)
+    columns = [updated.word_index[word] for word in retrained.word_list]
+    assert sorted(updated.word_list) == sorted(retrained.word_list)
+    matrix = updated.matrix.toarray() if sparse else updated.matrix
+    expected = retrained.matrix.toarray() if sparse else retrained.matrix
+    np.testing.assert_allclose(matrix[np.ix_(rows, columns)], expected, rtol=1e-12)
+    assert updated.totals == retrained.totals
+    assert updated.smoothed_totals == retrained.smoothed_totals
+
+
+def test_smoothed_emission_update_matches_retraining(tmp_path):
+    head, train, held_out = split_train("EN", tmp_path)
+    dev_words = getAllTokens(os.path.join(DATA, "EN", "dev.in"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        p = preprocess(head)
+        updated = SmoothedEmission(p.get_representer(), p.get_vocabulary(), p.get_states(), dev_words)
+        updated.update(held_out)
+        p = preprocess(train)
+        retrained = SmoothedEmission(p.get_representer(), p.get_vocabulary(), p.get_states(), dev_words)
+
+    rows = state_order(updated.states, retrained.states)
+    words = list(dict.fromkeys(retrained.word_list + dev_words + ["#never-seen#"]))
+    np.testing.assert_allclose(updated.token_probs(words)[rows], retrained.token_probs(words), rtol=1e-12)
+    assert updated.totals == retrained.totals
+
+
+def test_transition_update_matches_retraining(tmp_path):
+    head, train, held_out = split_train("EN", tmp_path)
+    updated = train_transition(Transition, head)
+    updated.update(held_out)
+    retrained = train_transition(Transition, train)
+
+    rows = state_order(updated.states, retrained.states)
+    np.testing.assert_array_equal(updated.transition_count[np.ix_(rows, rows)], retrained.transition_count)
+    np.testing.assert_allclose(updated.matrix[np.ix_(rows, rows)], retrained.matrix, rtol=1e-12)
+    np.testing.assert_allclose(updated.start[rows], retrained.start, rtol=1e-12)
+    np.testing.assert_allclose(updated.stop[rows], retrained.stop, rtol=1e-12)
+
+
+def test_transition2_update_matches_retraining(tmp_path):
+    head, train, held_out = split_train("EN", tmp_path)
+    updated = train_transition(Transition2, head)
+    updated.update(held_out)
+    retrained = train_transition(Transition2, train)
+
+    rows = state_order(updated.states, retrained.states)
+    n = len(rows)
+    pairs = (rows[:, np.newaxis] * n + rows[np.newaxis, :]).ravel()
+    np.testing.assert_allclose(updated.get_start_words()[rows], retrained.get_start_words(), rtol=1e-12)
+    np.testing.assert_allclose(updated.get_start_u_matrix()[np.ix_(rows, rows)], retrained.get_start_u_matrix(), rtol=1e-12)
+    np.testing.assert_allclose(updated.get_transition_matrix()[np.ix_(pairs, rows)], retrained.get_transition_matrix(), rtol=1e-12)
+    np.testing.assert_allclose(updated.get_stop_words()[pairs], retrained.get_stop_words(), rtol=1e-12)
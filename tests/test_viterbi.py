@@ -0,0 +1,47 @@
+import contextlib
+import io
+import os
+
+import pytest
+
+from compiled_hmm import CompiledHMM
+from emission import Emission
+from preprocess import Preprocessor, read_sentences
+from transition import Transition
+import viterbi
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def dev_sentences(language, limit=200):
+    sentences = [tokens for tokens, tags in read_sentences(os.path.join(DATA, language, "dev.in"), labelled=False)]
+    return sentences[:limit]
+
+
+@pytest.fixture(scope="module")
+def model():
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocessor = Preprocessor(os.path.join(DATA, "EN", "train"))
+        emission = Emission(preprocessor.get_representer(), preprocessor.get_vocabulary(), preprocessor.get_states())
+        transition = Transition()
+        transition.compute_params(preprocessor)
+    return CompiledHMM(emission, transition)
+
+
+def test_batch_best_path_matches_best_path(model):
+    sentences = dev_sentences("EN")
+    word_indices, mask = viterbi.index_sentences(model, sentences)
+    paths, probabilities = viterbi.batch_best_path(None, None, word_indices, mask, model)
+
+    for sentence, path, probability in zip(sentences, paths, probabilities):
+        expected_path, expected_probability = viterbi.best_path(None, None, sentence, model)
+        assert path == expected_path
+        assert probability == pytest.approx(expected_probability, rel=1e-9)
+
+
+def test_batch_best_path_handles_one_word_sentences(model):
+    sentences = [["hello"], ["good", "morning", "world"], ["#never-seen#"]]
+    word_indices, mask = viterbi.index_sentences(model, sentences)
+    paths = viterbi.batch_best_path(None, None, word_indices, mask, model)[0]
+
+    assert paths == [viterbi.best_path(None, None, sentence, model)[0] for sentence in sentences]